@@ -0,0 +1,68 @@
+"""
+Compare LLDP frames per second built with Ryu packet objects
+and patched from per switch templates by `fabric.packet.create_lldp`.
+
+Usage: python benchmarks/lldp.py [switches] [ports]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from ryu.lib.packet import packet as ryu_packet  # noqa: E402
+from ryu.lib.packet import ethernet  # noqa: E402
+from ryu.lib.packet import lldp  # noqa: E402
+from ryu.ofproto import ether as ethertypes  # noqa: E402
+
+import fabric.flows as flows  # noqa: E402
+import fabric.packet as packet  # noqa: E402
+
+
+REPEAT = 5
+
+
+def ryu_lldp(dpid, port_no):
+    """
+    Build an LLDP frame the way it was done before templates.
+    """
+    pkt = ryu_packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(lldp.LLDP_MAC_NEAREST_BRIDGE,
+                                       flows.int_to_mac(dpid),
+                                       ethertypes.ETH_TYPE_LLDP))
+    tlvs = (lldp.ChassisID(subtype=lldp.ChassisID.SUB_LOCALLY_ASSIGNED,
+                           chassis_id=hex(dpid)),
+            lldp.PortID(subtype=lldp.PortID.SUB_INTERFACE_NAME,
+                        port_id=hex(port_no)),
+            lldp.TTL(ttl=1),
+            lldp.End())
+    pkt.add_protocol(lldp.lldp(tlvs))
+    pkt.serialize()
+    return pkt.data
+
+
+def probe_all(create, switches, ports):
+    for dpid in range(1, switches + 1):
+        for port_no in range(1, ports + 1):
+            create(dpid, port_no)
+
+
+def main(switches=100, ports=48):
+    for dpid, port_no in ((1, 1), (2 ** 48 + 5, 48)):
+        old = packet.parse(ryu_lldp(dpid, port_no))
+        new = packet.parse(packet.create_lldp(dpid, port_no))
+        assert (old["peer_id"], old["peer_port"]) == \
+            (new["peer_id"], new["peer_port"]) == (dpid, port_no)
+
+    frames = switches * ports
+    print("%d switches x %d ports" % (switches, ports))
+    for name, create in (("ryu packet", ryu_lldp),
+                         ("template", packet.create_lldp)):
+        best = min(timeit.repeat(lambda: probe_all(create, switches, ports),
+                                 number=1, repeat=REPEAT))
+        print("%12s %12.0f frames/s" % (name, frames / best))
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*args)
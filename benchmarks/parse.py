@@ -0,0 +1,79 @@
+"""
+Compare PacketIn parsing throughput of Ryu packet objects and
+`fabric.packet.parse`, which unpacks headers with `struct`.
+
+Usage: python benchmarks/parse.py [frames]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from ryu.lib.packet import packet as ryu_packet  # noqa: E402
+from ryu.lib.packet import ethernet  # noqa: E402
+from ryu.lib.packet import arp  # noqa: E402
+from ryu.lib.packet import lldp  # noqa: E402
+from ryu.ofproto import ether as ethertypes  # noqa: E402
+
+import fabric.packet as packet  # noqa: E402
+
+
+REPEAT = 5
+
+
+def ryu_parse(data):
+    """
+    Parse a frame the way it was done before, decoding it once for
+    Ethernet and once more for ARP or LLDP.
+    """
+    pkt = ryu_packet.Packet(data)
+    pkt_eth = pkt.get_protocol(ethernet.ethernet)
+    headers = {"dl_src": pkt_eth.src,
+               "dl_dst": pkt_eth.dst,
+               "ethertype": pkt_eth.ethertype}
+    if headers["ethertype"] == ethertypes.ETH_TYPE_ARP:
+        pkt_arp = ryu_packet.Packet(data).get_protocol(arp.arp)
+        headers.update({"nl_src": pkt_arp.src_ip,
+                        "nl_dst": pkt_arp.dst_ip,
+                        "opcode": pkt_arp.opcode})
+    elif headers["ethertype"] == ethertypes.ETH_TYPE_LLDP:
+        pkt_lldp = ryu_packet.Packet(data).get_protocol(lldp.lldp)
+        headers.update({"peer_id": int(pkt_lldp.tlvs[0].chassis_id, 16),
+                        "peer_port": int(pkt_lldp.tlvs[1].port_id, 16)})
+    return headers
+
+
+def arp_request(nl_src, nl_dst):
+    pkt = ryu_packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(ethertype=ethertypes.ETH_TYPE_ARP,
+                                       dst="ff:ff:ff:ff:ff:ff",
+                                       src="02:00:00:00:00:01"))
+    pkt.add_protocol(arp.arp(opcode=arp.ARP_REQUEST,
+                             src_mac="02:00:00:00:00:01",
+                             src_ip=nl_src,
+                             dst_mac="00:00:00:00:00:00",
+                             dst_ip=nl_dst))
+    pkt.serialize()
+    return pkt.data
+
+
+def main(frames=100000):
+    samples = [("lldp", packet.create_lldp(0x1234, 7)),
+               ("arp", arp_request("10.0.0.1", "10.0.0.2"))]
+    for name, data in samples:
+        assert ryu_parse(data) == packet.parse(data), name
+
+    print("%8s %12s %12s %8s" % ("frame", "ryu, f/s", "struct, f/s",
+                                 "speedup"))
+    for name, data in samples:
+        slow = min(timeit.repeat(lambda: ryu_parse(data),
+                                 number=frames, repeat=REPEAT))
+        fast = min(timeit.repeat(lambda: packet.parse(data),
+                                 number=frames, repeat=REPEAT))
+        print("%8s %12.0f %12.0f %7.1fx" % (name, frames / slow,
+                                            frames / fast, slow / fast))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,85 @@
+"""
+Compare cost of purging one access port with a full table scan
+and with the indexes kept by `fabric.network.Network`.
+
+Usage: python benchmarks/purge.py [hosts ...]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from fabric.network import Network  # noqa: E402
+
+
+SWITCHES = 100  #: Access switches hosts are spread over
+PORTS = 48  #: Access ports per switch
+REPEAT = 5
+
+
+def populate(net, hosts):
+    """
+    Spread hosts over access ports, one MAC and one IP per host.
+    """
+    for i in range(hosts):
+        mac = "02:%02x:%02x:%02x:%02x:%02x" % tuple(
+            (i >> shift) & 0xff for shift in (32, 24, 16, 8, 0))
+        ip = "10.%d.%d.%d" % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+        location = (i % SWITCHES + 1, i // SWITCHES % PORTS + 1)
+        net.mac_to_port[mac] = location
+        net.ip_to_mac[ip] = mac
+
+
+def scan_purge(net, dpid, port_no):
+    """
+    Find hosts to purge the way it was done before the indexes,
+    by scanning every table.
+    """
+    purge_macs = set()
+    for mac, item in dict.items(net.mac_to_port):
+        table_dpid, table_port_no = item
+        if table_dpid == dpid and (not port_no or table_port_no == port_no):
+            purge_macs.add(mac)
+    purge_ips = [ip for ip, mac in dict.items(net.ip_to_mac)
+                 if mac in purge_macs]
+    return purge_macs, purge_ips
+
+
+def indexed_purge(net, dpid, port_no):
+    """
+    Purge through the indexes, restoring the state afterwards
+    so every run removes the same hosts.
+    """
+    macs = net.macs_on(dpid, port_no)
+    saved = [(mac, net.ips_of_mac(mac)) for mac in macs]
+    net.purge(dpid, port_no)
+    for mac, ips in saved:
+        net.mac_to_port[mac] = (dpid, port_no)
+        for ip in ips:
+            net.ip_to_mac[ip] = mac
+    return macs, [ip for mac, ips in saved for ip in ips]
+
+
+def main(sizes):
+    print("%10s %12s %12s %8s" % ("hosts", "scan, ms", "indexed, ms",
+                                  "speedup"))
+    for hosts in sizes:
+        net = Network()
+        populate(net, hosts)
+        for dpid in range(1, SWITCHES + 1):
+            net.add_switch(dpid)
+        scanned, indexed = scan_purge(net, 1, 1), indexed_purge(net, 1, 1)
+        assert scanned[0] == indexed[0]
+        assert sorted(scanned[1]) == sorted(indexed[1])
+
+        scan = min(timeit.repeat(lambda: scan_purge(net, 1, 1),
+                                 number=1, repeat=REPEAT))
+        indexed = min(timeit.repeat(lambda: indexed_purge(net, 1, 1),
+                                    number=1, repeat=REPEAT))
+        print("%10d %12.3f %12.3f %7.0fx" % (hosts, scan * 1000,
+                                             indexed * 1000, scan / indexed))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000])
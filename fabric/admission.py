@@ -0,0 +1,146 @@
+"""
+This module contains admission control of PacketIns.
+
+Every switch gets two token buckets: one for control plane ethertypes
+(LLDP, ARP), one for everything else. Every source MAC gets a bucket of
+its own on top of that, for everything but LLDP. Control traffic never
+competes with data misses for tokens, so a flood of misses from one
+host or switch can't starve discovery.
+"""
+from collections import OrderedDict
+
+
+class TokenBucket(object):
+
+    """
+    Allows `rate` events per second on average, `burst` at once.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now=0.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now):
+        """
+        Take a token if there is one.
+
+        :param now: current time
+        :type now: float
+
+        :returns: True if the event is admitted
+        :rtype: bool
+        """
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        self.tokens = tokens if tokens < self.burst else self.burst
+        self.stamp = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Admission(object):
+
+    """
+    Token bucket admission of PacketIns per switch and per source.
+    """
+
+    def __init__(self, rate=1000, burst=200, control_rate=1000,
+                 control_burst=500, source_rate=50, source_burst=20,
+                 control=(), sources=65536):
+        """
+        :param rate: data PacketIns per second of a switch
+        :type rate: float
+
+        :param burst: data PacketIns of a switch at once
+        :type burst: int
+
+        :param control_rate: control PacketIns per second of a switch
+        :type control_rate: float
+
+        :param control_burst: control PacketIns of a switch at once
+        :type control_burst: int
+
+        :param source_rate: PacketIns per second of a source MAC
+        :type source_rate: float
+
+        :param source_burst: PacketIns of a source MAC at once
+        :type source_burst: int
+
+        :param control: ethertypes of control plane
+        :type control: iterable of int
+
+        :param sources: source buckets kept, least recently used go first
+        :type sources: int
+        """
+        self.rate, self.burst = rate, burst
+        self.control_rate, self.control_burst = control_rate, control_burst
+        self.source_rate, self.source_burst = source_rate, source_burst
+        self.control = frozenset(control)
+        self.sources = sources
+        self._switches = {}  # (dpid, is control) => bucket
+        self._sources = OrderedDict()  # MAC => bucket
+        self.counters = {"admitted": 0, "dropped_switch": 0,
+                         "dropped_source": 0}
+
+    def admit(self, dpid, mac, ethertype, now, source=True):
+        """
+        Decide if a PacketIn is handled or dropped.
+
+        :param dpid: datapath id of the switch the packet came from
+        :type dpid: int
+
+        :param mac: source MAC of the packet
+        :type mac: str
+
+        :param ethertype: ethertype of the packet
+        :type ethertype: int
+
+        :param now: current time
+        :type now: float
+
+        :param source: also account packet to its source MAC
+        :type source: bool
+
+        :returns: True if the packet is to be handled
+        :rtype: bool
+        """
+        # a noisy source is held back before it eats into its switch
+        if source:
+            bucket = self._sources.pop(mac, None)
+            if bucket is None:
+                bucket = TokenBucket(self.source_rate, self.source_burst,
+                                     now)
+                if len(self._sources) >= self.sources:
+                    self._sources.popitem(last=False)
+            self._sources[mac] = bucket
+            if not bucket.take(now):
+                self.counters["dropped_source"] += 1
+                return False
+
+        control = ethertype in self.control
+        bucket = self._switches.get((dpid, control))
+        if bucket is None:
+            if control:
+                bucket = TokenBucket(self.control_rate, self.control_burst,
+                                     now)
+            else:
+                bucket = TokenBucket(self.rate, self.burst, now)
+            self._switches[dpid, control] = bucket
+        if not bucket.take(now):
+            self.counters["dropped_switch"] += 1
+            return False
+
+        self.counters["admitted"] += 1
+        return True
+
+    def forget_switch(self, dpid):
+        """
+        Drop buckets of a switch that went away.
+        """
+        self._switches.pop((dpid, True), None)
+        self._switches.pop((dpid, False), None)
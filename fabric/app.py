@@ -2,6 +2,12 @@
 This module contains controller application to manage
 a set of OpenFlow switches
 """
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+from timeit import default_timer
+import time
+
 from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER, DEAD_DISPATCHER
@@ -9,16 +15,66 @@ from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_4 as ofp
 from ryu.ofproto import ofproto_v1_4_parser as parser
 from ryu.ofproto import ether as ethertypes
+from ryu.lib import hub
 
+from fabric.admission import Admission
+from fabric.discovery import DiscoveryScheduler
 from fabric.network import Network
 import fabric.packet as packet
 import fabric.flows as flows
+import fabric.warmstart as warmstart
 
 
 IDLE_TIMEOUT = 10  #: Timeout for dynamic flows
 DEF_PRI = 0
 LOW_PRI = 1
 HIGH_PRI = 2
+SPF_WINDOW = 0.5  #: Seconds to coalesce topology events for, 0 to disable
+SPF_BATCH = 64  #: Topology events that force a recompute within the window
+SPF_WORKERS = 0  #: Processes to compute SPF in, 0 to compute on event loop
+SPF_POLL = 0.01  #: Seconds between checks for SPF results from workers
+SPF_DENSE = False  #: NumPy all pairs SPF for bulk recomputes, needs SPF_WINDOW
+WARM_START = None  #: File to keep network state in across restarts
+WARM_GRACE = 10  #: Seconds for restored switches and links to show up live
+WARM_INTERVAL = 30  #: Minimum seconds between snapshots
+PROBE_INTERVAL = 5.0  #: Seconds between LLDP probes of a port, 0 to disable
+PROBE_MISSES = 3  #: Probes in a row a link may miss before it expires
+PROBE_IDLE = 1.0  #: Seconds to sleep for when there are no ports to probe
+PROBE_HOLDOFF = 1.0  #: Seconds an extra probe suppresses repeated ones for
+PROBE_OUTSTANDING = 64  #: Extra probes allowed to be outstanding at once
+STATS_INTERVAL = 60  #: Seconds between PacketIn stats logs, 0 to disable
+ARP_CACHE = 65536  #: ARP replies kept ready to send
+ARP_PROACTIVE = True  #: Answer ARP for known IPs in switches
+HOST_HOLDOFF = 1.0  #: Seconds a learned host is not moved again for
+PACKET_IN_RATE = 1000  #: Data PacketIns per second of a switch, 0 to disable
+PACKET_IN_BURST = 200  #: Data PacketIns of a switch admitted at once
+CONTROL_RATE = 1000  #: LLDP and ARP PacketIns per second of a switch
+CONTROL_BURST = 500  #: LLDP and ARP PacketIns of a switch admitted at once
+SOURCE_RATE = 50  #: PacketIns per second of a source MAC
+SOURCE_BURST = 20  #: PacketIns of a source MAC admitted at once
+PACKET_IN_METERS = True  #: Cap PacketIn rates at the switches too
+METER_DATA = 1  #: Meter of table-miss PacketIns
+METER_CONTROL = 2  #: Meter of LLDP and ARP PacketIns
+PACKET_IN_BATCH = 64  #: PacketIns handled at once, 0 to handle on arrival
+PACKET_IN_QUEUE = 4096  #: PacketIns waiting for a batch, more are dropped
+CONTROL_QUEUE = 1024  #: LLDP and ARP PacketIns waiting, queued on their own
+BUNDLES = True  #: Apply flow and group mods to a switch in atomic bundles
+
+
+def port_speed(port):
+    """
+    Extract current speed from OpenFlow 1.4 port description.
+
+    :param port: port description
+    :type port: `parser.OFPPort`
+
+    :returns: current speed in kbps or None if not reported
+    :rtype: int
+    """
+    for prop in port.properties:
+        if prop.type == ofp.OFPPDPT_ETHERNET:
+            return prop.curr_speed
+    return None
 
 
 class NetworkManager(app_manager.RyuApp):
@@ -30,7 +86,104 @@ class NetworkManager(app_manager.RyuApp):
 
     def __init__(self, *args, **kwargs):
         super(NetworkManager, self).__init__(*args, **kwargs)
-        self.net = Network()  #: Init the Network instance
+        self.net = self.restore(
+            deferred=SPF_WINDOW > 0, dense=SPF_DENSE,
+            host_holdoff=HOST_HOLDOFF)  #: Init the Network instance
+        self.saved_at = time.time()
+        self.datapaths = {}  # dpid => Datapath
+        self.groups = {}  # destination dpid => group_id
+        self.destinations = {}  # group_id => destination dpid
+        self.bundle_ids = itertools.count(1)
+        self.bundles = {}  # (dpid, bundle_id) => (mods, xids) not committed
+        self.bundle_xids = {}  # (dpid, xid) => bundle_id
+        self.unacked = {}  # (dpid, xid) => mod sent on its own
+        self.barriers = {}  # (dpid, xid) of a barrier => xids it acks
+        self.no_bundles = set()  # dpids of switches without bundles
+        self.rejected = set()  # (src, dst) routes to send again
+        self.spf_pool = None
+        self.spf_wakeup = hub.Event()
+        self.arp_replies = packet.ArpReplyCache(ARP_CACHE)
+        self.arp_changes = {}  # IP => MAC or None, responders not yet sent
+        if ARP_PROACTIVE:
+            self.net.ip_to_mac.watchers.append(self._arp_changed)
+        self.dispatch = {}  # ethertype => PacketIn handler
+        self.packet_in_stats = {}  # ethertype => [count, seconds]
+        self.control = frozenset((ethertypes.ETH_TYPE_LLDP,
+                                  ethertypes.ETH_TYPE_ARP))
+        self.packet_in_queue = deque()  # (dp, in_port, data, ethertype)
+        self.control_queue = deque()  # same, of `self.control` ethertypes
+        self.packet_in_wakeup = hub.Event()
+        self.queue_stats = {"queued": 0, "dropped": 0, "dropped_control": 0,
+                            "batches": 0, "max_depth": 0}
+        self.admission = None
+        if PACKET_IN_RATE > 0:
+            self.admission = Admission(
+                PACKET_IN_RATE, PACKET_IN_BURST, CONTROL_RATE, CONTROL_BURST,
+                SOURCE_RATE, SOURCE_BURST, self.control)
+        self.register_ethertype(ethertypes.ETH_TYPE_LLDP, self._handle_lldp)
+        self.register_ethertype(ethertypes.ETH_TYPE_ARP, self._handle_arp)
+        self.discovery = DiscoveryScheduler(PROBE_INTERVAL, PROBE_MISSES,
+                                            PROBE_HOLDOFF, PROBE_OUTSTANDING,
+                                            ofp.OFPP_FLOOD)
+        if SPF_WINDOW > 0:
+            if SPF_WORKERS:
+                self.spf_pool = ProcessPoolExecutor(SPF_WORKERS)
+            self.threads.append(hub.spawn(self._spf_loop))
+        if self.net.unconfirmed:
+            self.threads.append(hub.spawn(self._validate))
+        if PROBE_INTERVAL > 0:
+            self.threads.append(hub.spawn(self._discovery_loop))
+        if STATS_INTERVAL > 0:
+            self.threads.append(hub.spawn(self._stats_loop))
+        if PACKET_IN_BATCH > 0:
+            self.threads.append(hub.spawn(self._packet_in_loop))
+
+    def restore(self, **kwargs):
+        """
+        Restore network state saved by a previous run from `WARM_START`,
+        or start from scratch if there is none.
+
+        :param kwargs: passed on to `Network`
+
+        :returns: network state
+        :rtype: `Network`
+        """
+        if WARM_START:
+            try:
+                net = warmstart.load(WARM_START, **kwargs)
+            except (IOError, OSError, ValueError) as e:
+                self.logger.info("Starting cold, no warm start: %s", e)
+            else:
+                self.logger.info("Restored %d switches, %d hosts from %s",
+                                 len(net.topo.switches), len(net.mac_to_port),
+                                 WARM_START)
+                return net
+        return Network(**kwargs)
+
+    def save(self):
+        """
+        Write network state to `WARM_START`.
+        """
+        if WARM_START:
+            warmstart.save(self.net, WARM_START)
+            self.saved_at = time.time()
+
+    def close(self):
+        self.save()
+
+    def _validate(self):
+        """
+        Purge restored state that hasn't shown up live within `WARM_GRACE`.
+        """
+        hub.sleep(WARM_GRACE)
+        macs = [mac for dpid in self.net.unconfirmed
+                if not isinstance(dpid, tuple)
+                for mac in self.net.macs_on(dpid)]
+        changed = self.net.validate()
+        self.logger.info("Warm start validated, %d pairs changed",
+                         len(changed))
+        self.install_routes(changed)
+        self.forget_hosts(macs)
 
     @set_ev_cls(ofp_event.EventOFPStateChange, [MAIN_DISPATCHER, DEAD_DISPATCHER])
     def _handle_state_change(self, ev):
@@ -48,42 +201,487 @@ class NetworkManager(app_manager.RyuApp):
         dp = ev.datapath
         assert dp is not None
         if ev.state == MAIN_DISPATCHER:
-            dp.send_msg(flows.flow_inbound(dp))
-            dp.send_msg(flows.flow_to_transit(dp))
-            dp.send_msg(flows.flow_default(dp, flows.T_DEFAULT, flows.T_LOCAL))
-            dp.send_msg(flows.flow_default(dp, flows.T_LOCAL))
+            self.datapaths[dp.id] = dp
+            # groups and flows of a previous connection are unknown,
+            # the pipeline is rebuilt from scratch in the same bundle
+            msgs = [flows.group_delete_all(dp),
+                    flows.flow_flush(dp),
+                    flows.flow_inbound(dp),
+                    flows.flow_to_transit(dp),
+                    flows.flow_default(dp, flows.T_DEFAULT, flows.T_LOCAL)]
+            msgs.extend(self.install_meters(dp))
+            if ARP_PROACTIVE:
+                for ip, mac in self.net.ip_to_mac.items():
+                    msgs.append(flows.flow_arp_reply(dp, ip, mac))
+            for mac, (dpid, port_no) in self.net.mac_to_port.items():
+                msgs.extend(self.flows_to_host(dp, mac, dpid, port_no))
+            self.install_routes(self.net.add_switch(dp.id), {dp.id: msgs})
+            dp.send_msg(flows.port_desc_request(dp))
             self.run_discovery(dp)
-            self.net.add_switch(dp.id)
         elif ev.state == DEAD_DISPATCHER:
-            self.net.purge(dp.id)
+            self.datapaths.pop(dp.id, None)
+            self.discovery.remove_switch(dp.id)
+            if self.admission is not None:
+                self.admission.forget_switch(dp.id)
+            self._forget_requests(dp.id)
+            macs = self.net.macs_on(dp.id)
+            self.install_routes(self.net.purge(dp.id))
+            self.forget_hosts(macs)
+
+    def install_meters(self, dp):
+        """
+        Send table-miss PacketIns and control plane ones through
+        separate meters, so that a switch itself drops misses over
+        `PACKET_IN_RATE` and they can't crowd out LLDP and ARP.
+
+        Without `PACKET_IN_METERS` or admission altogether, rules are
+        the same, less the meters.
+
+        With `ARP_PROACTIVE`, requests of learned hosts skip DEFAULT
+        table rules for ARP, see `flows.flow_arp_known`. ARP table gets
+        the same rules for requests it has no answer for.
+
+        Meters are sent right away, as bundles can't carry them.
+
+        :returns: flow mods that send PacketIns through the meters
+        :rtype: list of `parser.OFPFlowMod`
+        """
+        data = control = 0
+        if PACKET_IN_METERS and PACKET_IN_RATE > 0:
+            data, control = METER_DATA, METER_CONTROL
+            for meter_id, rate, burst in (
+                    (data, PACKET_IN_RATE, PACKET_IN_BURST),
+                    (control, CONTROL_RATE, CONTROL_BURST)):
+                # meters outlive a reconnect, add fails if one is left
+                dp.send_msg(flows.meter_packet_in(dp, meter_id, 0,
+                                                  command=ofp.OFPMC_DELETE))
+                dp.send_msg(flows.meter_packet_in(dp, meter_id, rate, burst))
+        msgs = [flows.flow_default(dp, flows.T_LOCAL, meter_id=data),
+                flows.flow_control(dp, ethertypes.ETH_TYPE_LLDP, control),
+                # unicast ARP is switched to hosts like anything else
+                flows.flow_control(dp, ethertypes.ETH_TYPE_ARP, control,
+                                   "ff:ff:ff:ff:ff:ff")]
+        if ARP_PROACTIVE:
+            msgs.extend([flows.flow_default(dp, flows.T_ARP, flows.T_LOCAL),
+                         flows.flow_control(dp, ethertypes.ETH_TYPE_ARP,
+                                            control, "ff:ff:ff:ff:ff:ff",
+                                            flows.T_ARP)])
+        return msgs
+
+    def send_msgs(self, dp, msgs):
+        """
+        Send flow and group mods to a switch, wrapped in an atomic
+        bundle if there is more than one and `BUNDLES` is set, so that
+        the switch never forwards with half of them applied.
+
+        A bundle the switch rejects is sent again one mod at a time,
+        so that a single bad mod doesn't hold back all the others.
+
+        :param dp: datapath to send to
+        :type dp: `ryu.controller.controller.Datapath`
+
+        :param msgs: messages to send, in order
+        :type msgs: list of `parser.OFPFlowMod` and `parser.OFPGroupMod`
+        """
+        if not BUNDLES or len(msgs) < 2 or dp.id in self.no_bundles:
+            self.send_acked(dp, msgs)
+            return
+        bundle_id = next(self.bundle_ids) & 0xffffffff
+        xids = []
+        for msg in flows.bundle(dp, bundle_id, msgs):
+            dp.send_msg(msg)
+            xids.append(msg.xid)
+            self.bundle_xids[dp.id, msg.xid] = bundle_id
+        self.bundles[dp.id, bundle_id] = (msgs, xids)
+
+    def send_acked(self, dp, msgs):
+        """
+        Send mods to a switch one by one, followed by a barrier, keeping
+        them until the barrier reply to tell which one an error is for.
+
+        :param dp: datapath to send to
+        :type dp: `ryu.controller.controller.Datapath`
+
+        :param msgs: messages to send, in order
+        :type msgs: list of `parser.OFPFlowMod` and `parser.OFPGroupMod`
+        """
+        if not msgs:
+            return
+        xids = []
+        for msg in msgs:
+            dp.send_msg(msg)
+            xids.append(msg.xid)
+            self.unacked[dp.id, msg.xid] = msg
+        barrier = parser.OFPBarrierRequest(dp)
+        dp.send_msg(barrier)
+        self.barriers[dp.id, barrier.xid] = xids
+
+    def _forget_bundle(self, dpid, bundle_id):
+        """
+        Stop tracking a bundle, return its mods or None if unknown.
+        """
+        bundle = self.bundles.pop((dpid, bundle_id), None)
+        if bundle is None:
+            return None
+        msgs, xids = bundle
+        for xid in xids:
+            self.bundle_xids.pop((dpid, xid), None)
+        return msgs
+
+    def _forget_requests(self, dpid):
+        """
+        Stop tracking bundles and mods sent to a switch that went away.
+        """
+        for table in (self.bundles, self.bundle_xids, self.unacked,
+                      self.barriers):
+            for key in [key for key in table if key[0] == dpid]:
+                del table[key]
+
+    @set_ev_cls(ofp_event.EventOFPBundleCtrlMsg, MAIN_DISPATCHER)
+    def _handle_bundle_reply(self, ev):
+        """
+        Stop tracking a bundle once the switch has committed it.
+        """
+        msg = ev.msg
+        if msg.type == ofp.OFPBCT_COMMIT_REPLY:
+            self._forget_bundle(msg.datapath.id, msg.bundle_id)
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def _handle_barrier_reply(self, ev):
+        """
+        Stop tracking mods sent before a barrier, the switch has
+        accepted every one it didn't report an error for.
+        """
+        dpid = ev.msg.datapath.id
+        for xid in self.barriers.pop((dpid, ev.msg.xid), ()):
+            self.unacked.pop((dpid, xid), None)
+
+    @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER)
+    def _handle_error(self, ev):
+        """
+        Fall back to sending mods of a failed bundle one by one,
+        and take back mods the switch has rejected. Rejected routes
+        are sent again along with the next `install_routes`.
+
+        :param ev: error and xid of the message that caused it
+        :type ev: `ofp_event.EventOFPErrorMsg`
+        """
+        msg = ev.msg
+        dp = msg.datapath
+        bundle_id = self.bundle_xids.get((dp.id, msg.xid))
+        if bundle_id is not None:
+            msgs = self._forget_bundle(dp.id, bundle_id)
+            if msg.type == ofp.OFPET_BAD_REQUEST and \
+                    msg.code == ofp.OFPBRC_BAD_TYPE:
+                self.logger.info("Switch %s has no bundles", dp.id)
+                self.no_bundles.add(dp.id)
+            else:
+                self.logger.warning("Switch %s failed bundle %d: type %d, "
+                                    "code %d", dp.id, bundle_id, msg.type,
+                                    msg.code)
+            self.send_acked(dp, msgs)
+            return
+
+        mod = self.unacked.pop((dp.id, msg.xid), None)
+        if mod is None:
+            self.logger.warning("Switch %s reported an error: type %d, "
+                                "code %d", dp.id, msg.type, msg.code)
+            return
+        self.logger.warning("Switch %s rejected %s: type %d, code %d",
+                            dp.id, mod.__class__.__name__, msg.type,
+                            msg.code)
+        group_id = flows.group_of_route(mod)
+        if group_id in self.destinations:
+            self.net.topo.unroute(dp.id, self.destinations[group_id])
+            self.rejected.add((dp.id, self.destinations[group_id]))
+        elif isinstance(mod, parser.OFPFlowMod):
+            unmetered = flows.unmetered(mod)
+            if unmetered is not None:  # switch has no meters
+                self.send_acked(dp, [unmetered])
+
+    def register_ethertype(self, ethertype, handler):
+        """
+        Route PacketIns of an ethertype to a handler.
+
+        :param ethertype: ethertype as read from the Ethernet header
+        :type ethertype: int
+
+        :param handler: called with datapath, in_port and frame;
+                        decodes only the headers it needs
+        :type handler: callable
+        """
+        self.dispatch[ethertype] = handler
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _handle_packet_in(self, ev):
         """
-        Parses incoming packet and calls a method that corresponds to dl_type.
+        Reads ethertype of incoming packet and queues it for
+        `process_packet_ins`, or handles it right away if
+        `PACKET_IN_BATCH` is 0.
+
+        PacketIns over the rates of their switch or source MAC are
+        dropped before anything else, see `fabric.admission`, and so
+        are ones that find the queue full. LLDP and ARP are queued
+        apart from data misses, so a flood of misses can't push
+        discovery and host learning out of the queue.
 
         :param ev: packet contents and match structure to describe its
                    headers.
         :type ev: `ofp_event.EventOFPPacketIn`
         """
         msg = ev.msg
-        dp = msg.datapath
-        in_port = msg.match['in_port']
+        ethertype = packet.ethertype(msg.data)
+        if ethertype is not None and self.admission is not None and \
+                not self.admission.admit(
+                    msg.datapath.id, packet.eth_src(msg.data), ethertype,
+                    time.time(), ethertype != ethertypes.ETH_TYPE_LLDP):
+            return
+        item = (msg.datapath, msg.match['in_port'], msg.data, ethertype)
+        if PACKET_IN_BATCH <= 0:
+            self.process_packet_ins([item])
+            return
+
+        if ethertype in self.control:
+            queue, limit = self.control_queue, CONTROL_QUEUE
+            dropped = "dropped_control"
+        else:
+            queue, limit = self.packet_in_queue, PACKET_IN_QUEUE
+            dropped = "dropped"
+        if len(queue) >= limit:
+            self.queue_stats[dropped] += 1
+            return
+        queue.append(item)
+        self.queue_stats["queued"] += 1
+        if len(queue) > self.queue_stats["max_depth"]:
+            self.queue_stats["max_depth"] = len(queue)
+        self.packet_in_wakeup.set()
+
+    def _packet_in_loop(self):
+        """
+        Drain queued PacketIns in batches of up to `PACKET_IN_BATCH`,
+        yielding to event handlers between batches. Batches are filled
+        from the control queue first.
+        """
+        control, queue = self.control_queue, self.packet_in_queue
+        while True:
+            self.packet_in_wakeup.wait()
+            self.packet_in_wakeup.clear()
+            while control or queue:
+                size = min(len(control), PACKET_IN_BATCH)
+                batch = [control.popleft() for _ in range(size)]
+                size = min(len(queue), PACKET_IN_BATCH - size)
+                batch.extend(queue.popleft() for _ in range(size))
+                self.process_packet_ins(batch)
+                hub.sleep(0)
+
+    def process_packet_ins(self, batch):
+        """
+        Learn hosts from a batch of PacketIns, then call the method
+        registered for the ethertype of every packet, dropping packets
+        there is none for.
+
+        A packet that fails to be handled is logged and dropped, it
+        doesn't take the rest of the batch, or the queue, with it.
+
+        Count and handling time of PacketIns are collected per ethertype
+        in `self.packet_in_stats`, learning is split evenly among them.
+
+        :param batch: datapath, in_port, frame and ethertype of PacketIns
+        :type batch: list of (`ryu.controller.controller.Datapath`, int,
+                     `bytearray`, int)
+        """
+        started = default_timer()
+        try:
+            self.learn_hosts(batch)
+        except Exception:
+            self.logger.exception("Learning hosts from PacketIns failed")
+        share = (default_timer() - started) / len(batch)
+        self.queue_stats["batches"] += 1
+
+        for dp, in_port, data, ethertype in batch:
+            started = default_timer()
+            handler = self.dispatch.get(ethertype)
+            if handler is not None:
+                try:
+                    handler(dp, in_port, data)
+                except Exception:
+                    self.logger.exception("PacketIn 0x%04x from %s failed",
+                                          ethertype, dp.id)
+
+            stats = self.packet_in_stats.get(ethertype)
+            if stats is None:
+                stats = self.packet_in_stats[ethertype] = [0, 0.0]
+            stats[0] += 1
+            stats[1] += default_timer() - started + share
+
+    def learn_hosts(self, batch):
+        """
+        Learn locations of the hosts that sent a batch of packets,
+        and their IPs from ARP. New or moved hosts get their switching
+        rules installed on every switch, so their traffic doesn't come
+        back, and so do responder flows of new IPs.
 
-        headers = packet.parse(msg.data)
-        if headers["ethertype"] == ethertypes.ETH_TYPE_LLDP:
-            self.net.add_peer(dp.id, headers["peer_id"], in_port)
-            if self.net.udl(dp.id, headers["peer_id"]):
-                self.run_discovery(dp)
-        elif (headers["ethertype"] == ethertypes.ETH_TYPE_ARP and
-              headers["opcode"] == 1):
-            pass
+        A host sending many packets of the batch is learned once,
+        at the location of its last one.
+
+        :param batch: datapath, in_port, frame and ethertype of PacketIns
+        :type batch: list of (`ryu.controller.controller.Datapath`, int,
+                     `bytearray`, int)
+        """
+        batch = [item for item in batch if item[3] is not None and
+                 item[3] != ethertypes.ETH_TYPE_LLDP]
+        if not batch:
+            return
+        locations = {}  # MAC => (dp, in_port)
+        ips = {}  # IP => MAC
+        macs = packet.eth_srcs([data for _, _, data, _ in batch])
+        for (dp, in_port, data, ethertype), mac in zip(batch, macs):
+            if int(mac[:2], 16) & 1:  # multicast source is never a host
+                continue
+            locations[mac] = (dp, in_port)
+            if ethertype == ethertypes.ETH_TYPE_ARP and \
+                    len(data) >= packet.ARP_FRAME.size:
+                ip = packet.parse_arp(data)["nl_src"]
+                if ip != "0.0.0.0":  # ARP probe of an address being claimed
+                    ips[ip] = mac
+
+        now = time.time()
+        learned = []
+        for mac, (dp, in_port) in locations.items():
+            if self.net.learn_host(mac, dp.id, in_port, None, now):
+                learned.append((mac, dp.id, in_port))
+        for ip, mac in ips.items():
+            dp, in_port = locations[mac]
+            self.net.learn_host(mac, dp.id, in_port, ip, now)
+
+        responders = self.arp_flows()
+        for peer in self.datapaths.values():
+            msgs = responders(peer)
+            for mac, dpid, port_no in learned:
+                msgs.extend(self.flows_to_host(peer, mac, dpid, port_no))
+            self.send_msgs(peer, msgs)
+
+    def flow_to_host(self, dp, mac, dpid, port_no):
+        """
+        Produce switching rule towards a host for a given switch:
+        out of the port if the host is local, over the fabric otherwise.
+        """
+        if dp.id == dpid:
+            return flows.flow_to_port(dp, mac, port_no)
+        return flows.flow_to_remote(dp, mac, dpid)
+
+    def flows_to_host(self, dp, mac, dpid, port_no):
+        """
+        Produce all rules of a learned host for a given switch:
+        switching towards it and, with `ARP_PROACTIVE`, answering its
+        ARP requests within the switch.
+        """
+        msgs = [self.flow_to_host(dp, mac, dpid, port_no)]
+        if ARP_PROACTIVE:
+            msgs.append(flows.flow_arp_known(dp, mac))
+        return msgs
+
+    def forget_hosts(self, macs):
+        """
+        Remove switching rules of hosts from every switch, along with
+        responder flows of their IPs.
+
+        :param macs: MAC addresses of the hosts
+        :type macs: iterable of str
+        """
+        macs = list(macs)
+        responders = self.arp_flows()
+        for dp in self.datapaths.values():
+            msgs = responders(dp)
+            for mac in macs:
+                msgs.append(flows.flow_forget_host(dp, mac))
+                if ARP_PROACTIVE:
+                    msgs.append(flows.flow_arp_known(
+                        dp, mac, ofp.OFPFC_DELETE_STRICT))
+            self.send_msgs(dp, msgs)
+
+    def _stats_loop(self):
+        """
+        Log PacketIn count and handling time per ethertype.
+        """
+        while True:
+            hub.sleep(STATS_INTERVAL)
+            stats = sorted(self.packet_in_stats.items(),
+                           key=lambda item: -item[1][1])
+            for ethertype, (count, seconds) in stats:
+                self.logger.info("PacketIn 0x%04x: %d, %.3f s, %.1f us avg",
+                                 ethertype or 0, count, seconds,
+                                 seconds / count * 1e6)
+            if self.admission is not None:
+                counters = self.admission.counters
+                self.logger.info("PacketIn admitted %d, dropped %d by switch, "
+                                 "%d by source", counters["admitted"],
+                                 counters["dropped_switch"],
+                                 counters["dropped_source"])
+            if PACKET_IN_BATCH > 0:
+                queue = self.queue_stats
+                self.logger.info("PacketIn queue: %d batches, %.1f avg, "
+                                 "depth %d now, %d max, %d dropped, "
+                                 "%d control dropped",
+                                 queue["batches"], queue["queued"] /
+                                 (queue["batches"] or 1),
+                                 len(self.packet_in_queue) +
+                                 len(self.control_queue),
+                                 queue["max_depth"], queue["dropped"],
+                                 queue["dropped_control"])
+
+    def _handle_lldp(self, dp, in_port, data):
+        """
+        Stores the link an LLDP probe has come over, and probes back
+        if the other direction is not known yet.
+        """
+        headers = packet.parse_lldp(data)
+        if not headers:  # sent by someone else, e.g. a host running lldpd
+            return
+        self.discovery.seen(dp.id, in_port,
+                            headers["peer_id"], headers["peer_port"])
+        macs = self.net.macs_on(dp.id, in_port)
+        if macs:  # learned before the port was known to be a fabric one
+            self.net.purge_hosts(macs)
+            self.forget_hosts(macs)
+        self.install_routes(
+            self.net.add_peer(dp.id, headers["peer_id"], in_port))
+        if self.net.udl(dp.id, headers["peer_id"]):
+            self.request_probe(dp, in_port)
+
+    def _handle_arp(self, dp, in_port, data):
+        """
+        Handles ARP requests.
+        """
+        headers = packet.parse(data)
+        if headers["opcode"] == 1:
+            self.reply_to_arp(dp, in_port, headers)
+
+    @set_ev_cls(ofp_event.EventOFPPortDescStatsReply, MAIN_DISPATCHER)
+    def _handle_port_desc(self, ev):
+        """
+        Stores current speed of every switch port so that link
+        costs can be derived from it.
+
+        :param ev: description of all ports of the switch
+        :type ev: `ofp_event.EventOFPPortDescStatsReply`
+        """
+        dpid = ev.msg.datapath.id
+        now = time.time()
+        for port in ev.msg.body:
+            if port.port_no <= ofp.OFPP_MAX and not \
+                    port.state & ofp.OFPPS_LINK_DOWN:
+                self.discovery.add_port(dpid, port.port_no, now)
+            speed = port_speed(port)
+            if speed:
+                self.install_routes(
+                    self.net.set_port_speed(dpid, port.port_no, speed))
 
     @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
     def _handle_port_status(self, ev):
         """
         Depending on `ev.msg.reason` adds or deletes port entry
-        in `self.net` and starts another round of LLDP discovery.
+        in `self.net` and starts or stops LLDP probing of the port.
 
         :param ev: port description and reason for state change
         :type ev: `ofp_event.EventOFPPortStatus`
@@ -95,27 +693,242 @@ class NetworkManager(app_manager.RyuApp):
 
         # port.state == 1 for link down and 0 for link up
         if msg.reason == ofp.OFPPR_DELETE or state:
-            self.net.purge(dpid, port_no)
+            self.discovery.remove_port(dpid, port_no)
+            macs = self.net.macs_on(dpid, port_no)
+            self.install_routes(self.net.purge(dpid, port_no))
+            self.forget_hosts(macs)
+        else:
+            speed = port_speed(msg.desc)
+            if speed:
+                self.install_routes(
+                    self.net.set_port_speed(dpid, port_no, speed))
+            if port_no <= ofp.OFPP_MAX:
+                self.discovery.add_port(dpid, port_no, time.time())
+                self.request_probe(msg.datapath, port_no)
+
+    def _spf_loop(self):
+        """
+        Recompute routes once per `SPF_WINDOW` if topology has changed,
+        or earlier if woken up by `install_routes`. Without topology
+        changes, routes rejected by switches are retried.
+        """
+        while True:
+            self.spf_wakeup.wait(SPF_WINDOW)
+            self.spf_wakeup.clear()
+            if not self.net.pending:
+                if self.rejected:
+                    self.install_routes(())
+                continue
+            try:
+                self.recompute()
+                if time.time() - self.saved_at > WARM_INTERVAL:
+                    self.save()
+            except Exception:
+                # pending events stay pending, next window retries them
+                self.logger.exception("SPF recompute failed")
+
+    def recompute(self):
+        """
+        Reroute all pending topology changes at once and install
+        resulting routes.
+
+        With `SPF_WORKERS` set, trees are computed in a worker process
+        from a snapshot of the topology, while this green thread yields
+        to event handlers. Results are discarded if the topology has
+        changed before they came back, pending events stay pending.
+        """
+        if self.spf_pool is None:
+            changed = self.net.flush()
         else:
-            self.run_discovery(msg.datapath)
+            version, costs, roots = self.net.topo.snapshot()
+            job = self.spf_pool.submit(self.net.topo.solver, costs, roots)
+            while not job.done():
+                hub.sleep(SPF_POLL)
+            changed = self.net.flush(job.result(), version)
+            if changed is None:
+                self.logger.info("SPF result for version %d is stale", version)
+                return
+        self.logger.info("SPF recompute absorbed %d events, %d pairs changed",
+                         self.net.absorbed, len(changed))
+        self.install_routes(changed)
+
+    def install_routes(self, pairs, before=None):
+        """
+        Program TRANSIT table for the given (src, dst) pairs.
+
+        Every switch forwards PBB traffic for a remote switch through
+        a select group with a bucket per equal cost next hop. Only
+        next hops that differ from what was installed before are sent,
+        in one bundle per switch.
+
+        Wakes up the recompute loop once `SPF_BATCH` topology events
+        are pending. Routes rejected by switches since the last call
+        are retried with the given pairs.
 
-    def reply_to_arp(self, dp, pkt):
+        :param pairs: switch pairs whose next hops have changed
+        :type pairs: iterable of (int, int)
+
+        :param before: mods to put ahead of the routes of a switch,
+                       in the same bundle
+        :type before: {dpid: list of `parser.OFPFlowMod`}
         """
-        Responds to incoming ARP request using `self.net.mac_of` dict
+        if SPF_BATCH and self.net.pending >= SPF_BATCH:
+            self.spf_wakeup.set()
+        before = before or {}
+        if self.rejected:
+            pairs = self.rejected.union(pairs)
+            self.rejected = set()
+        delta = self.net.topo.diff(pairs)
+        for dpid in set(delta) | set(before):
+            dp = self.datapaths.get(dpid)
+            if dp is None:
+                continue
+            msgs = list(before.get(dpid, ()))
+            if dpid in delta:
+                msgs.extend(flows.flows_from_delta(dp, delta[dpid],
+                                                   self.group_of))
+            self.send_msgs(dp, msgs)
+
+    def group_of(self, dpid):
+        """
+        Return group id used on every switch for routes towards `dpid`.
+
+        :param dpid: destination switch id
+        :type dpid: int
+
+        :returns: group id
+        :rtype: int
+        """
+        group_id = self.groups.get(dpid)
+        if group_id is None:
+            group_id = self.groups[dpid] = len(self.groups) + 1
+            self.destinations[group_id] = dpid
+        return group_id
+
+    def _arp_changed(self, ip, mac):
+        """
+        Keep ARP responder flows of all switches in line with
+        `self.net.ip_to_mac`. Requests for IPs without a flow still
+        reach `reply_to_arp`.
+
+        Changes are collected here and go out along with host flows
+        from `learn_hosts` and `forget_hosts`, the only places IPs
+        change in, see `arp_flows`.
+
+        :param ip: IP whose MAC has changed
+        :type ip: str
+
+        :param mac: new MAC or None if the IP is gone
+        :type mac: str
+        """
+        self.arp_changes[ip] = mac
+
+    def arp_flows(self):
+        """
+        Take responder flow changes collected by `_arp_changed`.
+
+        :returns: function producing the flow mods for a given switch
+        :rtype: callable
+        """
+        changes, self.arp_changes = self.arp_changes, {}
+
+        def responders(dp):
+            msgs = []
+            for ip, mac in changes.items():
+                if mac is None:
+                    msgs.append(flows.flow_arp_reply(
+                        dp, ip, "00:00:00:00:00:00",
+                        ofp.OFPFC_DELETE_STRICT))
+                else:
+                    msgs.append(flows.flow_arp_reply(dp, ip, mac))
+            return msgs
+        return responders
+
+    def reply_to_arp(self, dp, in_port, pkt):
+        """
+        Responds to incoming ARP request using `self.net.ip_to_mac` dict
+
+        Replies come ready to send from `self.arp_replies`, requests
+        for unknown IPs are left unanswered.
 
         :param dp: datapath object that corresponds to originating switch
         :type dp: `ryu.controller.controller.Datapath`
 
+        :param in_port: port the request came in on
+        :type in_port: int
+
         :param pkt: parsed eth and ARP headers of the request
         :type pkt: dict
         """
-        dl_dst, nl_dst, nl_src = pkt["dl_src"], pkt["nl_src"], pkt["nl_dst"]
-        dl_src = self.net.ip_to_mac[nl_src]
-        out_port = dp.ofproto.OFPP_LOCAL
+        reply = self.arp_replies.reply(self.net.ip_to_mac, pkt["nl_dst"],
+                                       pkt["dl_src"], pkt["nl_src"])
+        if reply is None:
+            return
+        dp.send_msg(flows.send_packet_out(dp, reply, ofp.OFPP_IN_PORT,
+                                          in_port))
+
+    def _discovery_loop(self):
+        """
+        Send LLDP probes as they come due and expire links whose
+        probes went unanswered.
+        """
+        while True:
+            try:
+                self.run_probes(time.time())
+            except Exception:
+                self.logger.exception("LLDP probing failed")
+
+            deadline = self.discovery.next_deadline()
+            hub.sleep(PROBE_IDLE if deadline is None
+                      else min(PROBE_IDLE, max(0, deadline - time.time())))
+
+    def run_probes(self, now):
+        """
+        Send probes that are due and expire links that missed theirs.
+
+        :param now: current time
+        :type now: float
+        """
+        probes, expired = self.discovery.due(now)
+        for dpid, port_no in probes:
+            dp = self.datapaths.get(dpid)
+            if dp is not None:
+                self.probe(dp, port_no)
+        for dpid, peer in expired:
+            self.logger.info("Link %s => %s expired", dpid, peer)
+            self.install_routes(self.net.remove_peer(dpid, peer))
+
+    def probe(self, dp, port_no):
+        """
+        Sends LLDP out of a single port of a given switch
+
+        :param dp: datapath object that corresponds to originating switch
+        :type dp: `ryu.controller.controller.Datapath`
+
+        :param port_no: port to send probe out of
+        :type port_no: int
+        """
+        pkt_lldp = packet.create_lldp(dp.id, port_no)
+        dp.send_msg(flows.send_packet_out(dp, pkt_lldp, port_no))
+
+    def request_probe(self, dp, port_no):
+        """
+        Sends LLDP out of a port unless one is already on its way,
+        or too many are outstanding. Suppressed probes are counted
+        in `self.discovery.counters`.
 
-        pkt = packet.create_arp(dl_src, dl_dst, nl_src, nl_dst)
+        :param dp: datapath object that corresponds to originating switch
+        :type dp: `ryu.controller.controller.Datapath`
 
-        flows.send_out_packet(dp, pkt, out_port)
+        :param port_no: port to send probe out of, or `ofp.OFPP_FLOOD`
+        :type port_no: int
+        """
+        if self.discovery.request(dp.id, port_no, time.time()):
+            self.probe(dp, port_no)
+        else:
+            self.logger.debug("Suppressed LLDP probe of %s:%s, %d so far",
+                              dp.id, port_no,
+                              self.discovery.counters["suppressed"])
 
     def run_discovery(self, dp):
         """
@@ -124,6 +937,4 @@ class NetworkManager(app_manager.RyuApp):
         :param datapath: datapath object that corresponds to originating switch
         :type datapath: `ryu.controller.controller.Datapath`
         """
-        pkt_lldp = packet.create_lldp(dp.id)
-        msg = flows.send_packet_out(dp, pkt_lldp, ofp.OFPP_FLOOD)
-        dp.send_msg(msg)
+        self.request_probe(dp, ofp.OFPP_FLOOD)
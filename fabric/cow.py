@@ -0,0 +1,108 @@
+"""
+This module contains immutable maps that share structure across versions.
+
+Keys are spread over a fixed number of shards by hash. A new version
+copies only the shards its changes fall into and shares all the others
+with the version it was derived from, so it costs O(changes) rather
+than O(size).
+"""
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+SHARDS = 256  #: Shards per map, a change copies 1/SHARDS of the map
+DELETED = object()  #: Marks a key removed in `FrozenMap.evolve`
+
+_EMPTY = {}  # shared by all empty shards, never modified
+
+
+class FrozenMap(Mapping):
+
+    """
+    Immutable mapping made of shards shared with other versions.
+    """
+
+    __slots__ = ("_shards", "_len")
+
+    def __init__(self, items=()):
+        """
+        :param items: initial contents
+        :type items: mapping or iterable of (key, value)
+        """
+        shards = [_EMPTY] * SHARDS
+        if isinstance(items, Mapping):
+            items = items.items()
+        for key, value in items:
+            i = hash(key) % SHARDS
+            if shards[i] is _EMPTY:
+                shards[i] = {}
+            shards[i][key] = value
+        self._shards = tuple(shards)
+        self._len = sum(len(shard) for shard in shards)
+
+    def evolve(self, changes):
+        """
+        Derive a new version with the given changes applied.
+
+        :param changes: new values, or `DELETED` for removed keys
+        :type changes: mapping
+
+        :returns: new version, or this one if nothing has changed
+        :rtype: `FrozenMap`
+        """
+        if not changes:
+            return self
+        shards = list(self._shards)
+        copied = set()
+        length = self._len
+        for key, value in changes.items():
+            i = hash(key) % SHARDS
+            if i not in copied:
+                shards[i] = dict(shards[i])
+                copied.add(i)
+            shard = shards[i]
+            if value is DELETED:
+                if key in shard:
+                    del shard[key]
+                    length -= 1
+            else:
+                if key not in shard:
+                    length += 1
+                shard[key] = value
+
+        new = FrozenMap.__new__(FrozenMap)
+        new._shards = tuple(shards)
+        new._len = length
+        return new
+
+    def shared(self, other):
+        """
+        Return number of shards this version shares with another one.
+        """
+        return sum(1 for a, b in zip(self._shards, other._shards) if a is b)
+
+    def __getitem__(self, key):
+        return self._shards[hash(key) % SHARDS][key]
+
+    def __contains__(self, key):
+        return key in self._shards[hash(key) % SHARDS]
+
+    def get(self, key, default=None):
+        return self._shards[hash(key) % SHARDS].get(key, default)
+
+    def __iter__(self):
+        for shard in self._shards:
+            for key in shard:
+                yield key
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return "FrozenMap(%r)" % dict(self)
+
+    def __reduce__(self):
+        # string hashes differ between processes, shards are rebuilt
+        return FrozenMap, (dict(self),)
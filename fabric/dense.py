@@ -0,0 +1,186 @@
+"""
+This module contains NumPy backed topology for large fabrics.
+
+Switches are mapped to dense indices, links are kept as adjacency,
+port and cost matrices, and all pairs shortest paths are computed
+with vectorized Floyd-Warshall instead of a search per switch.
+All pairs only pay off when most trees are rebuilt at once, so this is
+meant for bulk rebuilds of deferred rerouting, see `spf_trees`.
+
+NumPy is optional: everything else in the package works without it.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from fabric import network
+
+
+INF = 2 ** 40  #: Cost of a missing link, sum of two still fits int64
+MIN_ROOTS = 0.1  #: Share of switches below which trees are searched per root
+
+
+class DenseTopology(object):
+
+    """
+    All pairs shortest paths over a dense matrix representation
+    of the topology.
+    """
+
+    def __init__(self, costs, ports=None):
+        """
+        :param costs: link costs, as in `TopologyGraph.costs`
+        :type costs: {dpid: {dpid: int}}
+
+        :param ports: out ports, as in `TopologyGraph._adj`;
+                      only needed for `port`
+        :type ports: {dpid: {dpid: int}}
+        """
+        if np is None:
+            raise ImportError("NumPy is required for the dense backend")
+
+        dpids = set(costs)
+        for peers in costs.values():
+            dpids.update(peers)
+        self.dpids = sorted(dpids)  #: index => dpid
+        self.index = dict((dpid, i) for i, dpid in enumerate(self.dpids))
+        n = len(self.dpids)
+
+        self.adj = np.zeros((n, n), dtype=bool)
+        self.cost = np.full((n, n), INF, dtype=np.int64)
+        self.port = np.zeros((n, n), dtype=np.int64)
+        for src, peers in costs.items():
+            i = self.index[src]
+            for dst, cost in peers.items():
+                j = self.index[dst]
+                self.adj[i, j] = True
+                self.cost[i, j] = cost
+                if ports is not None:
+                    self.port[i, j] = ports[src][dst]
+
+        self.dist, self.next_hop = self._floyd_warshall()
+
+    def _floyd_warshall(self):
+        """
+        Compute cost and first hop matrices between all pairs.
+
+        Each round relaxes every pair through switch `k` at once;
+        a pair that got cheaper takes its first hop from (i, k).
+
+        :returns: dist and next_hop matrices, -1 if unreachable
+        :rtype: (`np.ndarray`, `np.ndarray`)
+        """
+        n = len(self.dpids)
+        nodes = np.arange(n)
+        dist = self.cost.copy()
+        dist[nodes, nodes] = 0
+        next_hop = np.where(self.adj, nodes[None, :], -1)
+        next_hop[nodes, nodes] = nodes
+
+        for k in range(n):
+            via = dist[:, k, None] + dist[None, k, :]
+            better = via < dist
+            if not better.any():
+                continue
+            dist = np.where(better, via, dist)
+            next_hop = np.where(better, next_hop[:, k, None], next_hop)
+        dist[dist >= INF] = INF
+        return dist, next_hop
+
+    def path(self, src, dst):
+        """
+        Follow first hops between two switches.
+
+        :returns: path to dst from src or None if unreachable
+        :rtype: list of int
+        """
+        i, j = self.index.get(src), self.index.get(dst)
+        if i is None or j is None or self.dist[i, j] >= INF:
+            return None
+        path = [i]
+        while i != j:
+            i = self.next_hop[i, j]
+            path.append(i)
+        return [self.dpids[k] for k in path]
+
+    def paths(self, switches):
+        """
+        Produce paths in the format of `TopologyGraph.paths`.
+
+        :param switches: dpids to compute paths between
+        :type switches: iterable of int
+
+        :returns: (src, dst) => [dpid, ...] or None if unreachable
+        :rtype: dict
+        """
+        switches = list(switches)
+        return dict(((src, dst), self.path(src, dst))
+                    for src in switches for dst in switches if src != dst)
+
+    def tree(self, root):
+        """
+        Extract a shortest path tree in the format of `shortest_path_tree`.
+
+        Equal cost next hops of the root towards `j` are the peers `k`
+        for which cost(root, k) + dist(k, j) == dist(root, j).
+        Previous hop of `j` is the lowest of the switches `p` linked to it
+        for which dist(root, p) + cost(p, j) == dist(root, j), as picked
+        by `shortest_path_tree`.
+
+        :param root: dpid of the root switch
+        :type root: int
+
+        :returns: path cost, previous hop and equal cost next hops
+                  of `root` for every reachable dpid
+        :rtype: ({dpid: int}, {dpid: dpid}, {dpid: set of dpid})
+        """
+        dpids = self.dpids
+        i = self.index.get(root)
+        if i is None:
+            return {root: 0}, {root: None}, {root: set()}
+
+        row = self.dist[i]
+        peers = np.nonzero(self.adj[i])[0]
+        equal = (self.cost[i, peers][:, None] + self.dist[peers, :]) == row
+        peers = [dpids[k] for k in peers.tolist()]
+        # dpids are sorted, the first equal cost predecessor is the lowest
+        preds = self.adj & (row[:, None] + self.cost == row[None, :])
+        pred = np.argmax(preds, axis=0).tolist()
+
+        dist, parent, hops = {root: 0}, {root: None}, {root: set()}
+        for j, (cost, via) in enumerate(zip(row.tolist(), equal.T.tolist())):
+            if cost >= INF or j == i:
+                continue
+            dpid = dpids[j]
+            dist[dpid] = cost
+            parent[dpid] = dpids[pred[j]]
+            hops[dpid] = set(peer for peer, ok in zip(peers, via) if ok)
+        return dist, parent, hops
+
+
+def spf_trees(costs, roots):
+    """
+    Drop-in replacement for `fabric.network.spf_trees` that computes
+    all pairs at once with `DenseTopology`.
+
+    Floyd-Warshall costs the same however few trees are asked for,
+    so with fewer roots than `MIN_ROOTS` of all switches it falls back
+    to a search per root.
+
+    :param costs: link costs
+    :type costs: {dpid: {dpid: int}}
+
+    :param roots: dpids of the root switches
+    :type roots: list of int
+
+    :returns: tree for every root
+    :rtype: {dpid: tree}
+    """
+    dpids = set(costs)
+    for peers in costs.values():
+        dpids.update(peers)
+    if len(roots) < MIN_ROOTS * len(dpids):
+        return network.spf_trees(costs, roots)
+    dense = DenseTopology(costs)
+    return dict((root, dense.tree(root)) for root in roots)
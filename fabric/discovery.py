@@ -0,0 +1,191 @@
+"""
+This module contains pacing of LLDP probes and liveness of discovered links.
+
+Every switch port is probed on its own, once per interval. Ports are
+spread evenly over the interval, so PacketIns caused by probes arrive
+at a flat rate instead of in a burst per flood. A link learned from
+the probes of a port is expired once that many probes in a row go
+unanswered.
+
+Probes asked for outside of the schedule, e.g. to confirm the other
+direction of a unidirectional link, are de-duplicated: while one is
+outstanding for a port, more are suppressed, and so is everything over
+a bound on outstanding probes.
+"""
+from fabric.pqdict import PQDict
+
+
+PHASE_STEP = 0.6180339887498949  #: Golden ratio, keeps phases spread out
+
+
+class DiscoveryScheduler(object):
+
+    """
+    Deadline queue of LLDP probes with per port miss counters,
+    and de-duplication of extra probes.
+    """
+
+    def __init__(self, interval=5.0, misses=3, holdoff=1.0, outstanding=64,
+                 flood=None):
+        """
+        :param interval: seconds between two probes of the same port
+        :type interval: float
+
+        :param misses: probes in a row a link may miss before it expires
+        :type misses: int
+
+        :param holdoff: seconds an extra probe stays outstanding
+                        if it doesn't come back
+        :type holdoff: float
+
+        :param outstanding: maximum of extra probes outstanding at once
+        :type outstanding: int
+
+        :param flood: port number of probes flooded out of all ports,
+                      which cover probes of single ports of the switch
+        :type flood: int
+        """
+        self.interval = interval
+        self.misses = misses
+        self.holdoff = holdoff
+        self.outstanding = outstanding
+        self.flood = flood
+        self.pending = PQDict()  # (dpid, port_no) => time extra probe sent
+        self.counters = {"requested": 0, "suppressed": 0, "expired": 0}
+        self.deadlines = PQDict()  # (dpid, port_no) => time of next probe
+        self.missed = {}  # (dpid, port_no) => unanswered probes in a row
+        self.learned = {}  # (dpid, port_no) => {(dpid, peer), ...}
+        self._phase = 0.0
+
+    def add_port(self, dpid, port_no, now):
+        """
+        Start probing a port.
+
+        Phase of every new port within the interval is picked from
+        a low-discrepancy sequence, so that ports of all switches stay
+        evenly spread no matter how many there are.
+
+        :param dpid: datapath id of the switch
+        :type dpid: int
+
+        :param port_no: port number
+        :type port_no: int
+
+        :param now: current time
+        :type now: float
+        """
+        key = (dpid, port_no)
+        if key in self.deadlines:
+            return
+        self._phase = (self._phase + PHASE_STEP) % 1.0
+        self.deadlines.additem(key, now + self._phase * self.interval)
+        self.missed[key] = 0
+
+    def remove_port(self, dpid, port_no):
+        """
+        Stop probing a port and forget links learned from it.
+
+        :returns: links that were learned from probes of the port
+        :rtype: set of (int, int)
+        """
+        key = (dpid, port_no)
+        self.deadlines.pop(key, None)
+        self.missed.pop(key, None)
+        self.pending.pop(key, None)
+        return self.learned.pop(key, set())
+
+    def remove_switch(self, dpid):
+        """
+        Stop probing all ports of a switch.
+        """
+        keys = set(self.missed) | set(self.pending) | set(self.learned)
+        for key in [key for key in keys if key[0] == dpid]:
+            self.remove_port(*key)
+
+    def request(self, dpid, port_no, now):
+        """
+        Ask for an extra probe of a port, or of all ports of a switch
+        if `port_no` is a flood.
+
+        :param dpid: datapath id of the switch
+        :type dpid: int
+
+        :param port_no: port number, as carried in the probe
+        :type port_no: int
+
+        :param now: current time
+        :type now: float
+
+        :returns: True if the probe should be sent, False if suppressed
+        :rtype: bool
+        """
+        self.counters["requested"] += 1
+        while self.pending and self.pending.topitem()[1] <= now - self.holdoff:
+            self.pending.popitem()
+
+        key = (dpid, port_no)
+        if key in self.pending or (dpid, self.flood) in self.pending or \
+                len(self.pending) >= self.outstanding:
+            self.counters["suppressed"] += 1
+            return False
+        self.pending.additem(key, now)
+        return True
+
+    def seen(self, dpid, port_no, peer, peer_port):
+        """
+        Account for a probe that came back.
+
+        :param dpid: datapath id of the switch that received the probe
+        :type dpid: int
+
+        :param port_no: port the probe was received on
+        :type port_no: int
+
+        :param peer: datapath id of the switch that sent the probe
+        :type peer: int
+
+        :param peer_port: port the probe was sent out of
+        :type peer_port: int
+        """
+        key = (peer, peer_port)
+        if key in self.missed:
+            self.missed[key] = 0
+        self.pending.pop(key, None)
+        self.learned.setdefault(key, set()).add((dpid, peer))
+
+    def next_deadline(self):
+        """
+        Return time of the earliest probe, or None if there are no ports.
+        """
+        if not self.deadlines:
+            return None
+        return self.deadlines.topitem()[1]
+
+    def due(self, now):
+        """
+        Take ports whose probe is due and schedule their next one.
+
+        :param now: current time
+        :type now: float
+
+        :returns: ports to probe now, and links to expire as their
+                  probes went unanswered `misses` times in a row
+        :rtype: (list of (int, int), set of (int, int))
+        """
+        probes, expired = [], set()
+        while self.deadlines:
+            key, deadline = self.deadlines.topitem()
+            if deadline > now:
+                break
+            # catch up without a burst if the loop was held up
+            deadline += self.interval
+            if deadline <= now:
+                deadline = now + self.interval
+            self.deadlines.updateitem(key, deadline)
+            probes.append(key)
+
+            self.missed[key] += 1
+            if self.missed[key] > self.misses and key in self.learned:
+                expired |= self.learned.pop(key)
+        self.counters["expired"] += len(expired)
+        return probes, expired
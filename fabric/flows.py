@@ -6,11 +6,14 @@ No to switch communication is supposed to reside in here.
 
 from ryu.ofproto import ofproto_v1_4 as ofp
 from ryu.ofproto import ofproto_v1_4_parser as parser
+from ryu.ofproto import ether as ethertypes
 from ryu.lib.ofctl_v1_3 import actions_to_str
+from ryu.lib.packet import arp
 import netaddr
 T_DEFAULT = 0
 T_TRANSIT = 1
 T_LOCAL = 2
+T_ARP = 3
 P_DEFAULT = 0
 P_LOW = 10
 P_HIGH = 20
@@ -20,7 +23,7 @@ class _ryu_dialect(netaddr.mac_unix):
     word_fmt = '%.2x'
 
 
-def compose(actions=[], to_table=0):
+def compose(actions=[], to_table=0, meter_id=0):
     """
     Compose instructions set from given entries.
 
@@ -31,10 +34,16 @@ def compose(actions=[], to_table=0):
                      value 0 (default table) will be ignored
     :type to_table: int
 
+    :param meter_id: meter to pass matched packets through first;
+                     value 0 means no meter
+    :type meter_id: int
+
     :returns: instructions for `parser.OFPFlowMod`
     :rtype: list of `parser.OFPInstruction`
     """
     inst = []
+    if meter_id:
+        inst.append(parser.OFPInstructionMeter(meter_id, ofp.OFPIT_METER))
     if actions:
         inst.append(
             parser.OFPInstructionActions(ofp.OFPIT_APPLY_ACTIONS,
@@ -85,7 +94,7 @@ def flow_to_port(dp, dl_dst, out_port, table=T_LOCAL):
     inst = compose([parser.OFPActionOutput(out_port)])
     msg = parser.OFPFlowMod(datapath=dp,
                             priority=P_LOW,
-                            match=parser.OFPmatch(eth_dst=dl_dst),
+                            match=parser.OFPMatch(eth_dst=dl_dst),
                             instructions=inst,
                             table_id=table)
 
@@ -116,13 +125,38 @@ def flow_to_remote(dp, dl_dst, dpid):
         ]
 
     msg = parser.OFPFlowMod(datapath=dp,
-                            match=parser.OFPmatch(eth_dst=dl_dst),
+                            priority=P_LOW,
+                            match=parser.OFPMatch(eth_dst=dl_dst),
                             instructions=compose(actions, to_table=T_TRANSIT),
                             table_id=T_LOCAL)
     return msg
 
 
-def flow_default(dp, table, to_table=0):
+def flow_forget_host(dp, dl_dst):
+    '''
+    Create a FlowMod structure that removes local or remote switching
+    rules of a host.
+
+    :param dp: switch description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :param dl_dst: MAC address of the host
+    :type dl_dst: str
+
+    :returns: FlowMod to send to the switch
+    :rtype: `parser.OFPFlowMod`
+    '''
+    msg = parser.OFPFlowMod(datapath=dp,
+                            command=ofp.OFPFC_DELETE_STRICT,
+                            priority=P_LOW,
+                            match=parser.OFPMatch(eth_dst=dl_dst),
+                            out_port=ofp.OFPP_ANY,
+                            out_group=ofp.OFPG_ANY,
+                            table_id=T_LOCAL)
+    return msg
+
+
+def flow_default(dp, table, to_table=0, meter_id=0):
 
     '''
     Produce an default rule that will be matching anything before applying an
@@ -140,6 +174,9 @@ def flow_default(dp, table, to_table=0):
     :param to_table: flow table to switch traffic to
     :type to_table: int
 
+    :param meter_id: meter to cap the rate of matched packets with
+    :type meter_id: int
+
     :return: message to send to the switch
     :type: `parser.OFPFlowMod`
     '''
@@ -154,7 +191,168 @@ def flow_default(dp, table, to_table=0):
                             priority=P_DEFAULT,
                             table_id=table,
                             match=match,
-                            instructions=compose(actions, to_table))
+                            instructions=compose(actions, to_table,
+                                                 meter_id))
+    return msg
+
+
+def flow_control(dp, eth_type, meter_id=0, eth_dst=None, table=T_DEFAULT):
+    '''
+    Produce a FlowMod, for DEFAULT table unless told otherwise, that
+    sends control plane packets of an ethertype straight to the
+    controller.
+
+    Control packets bypass the table-miss rules, and so their meter,
+    and get a meter of their own instead. A flood of misses can't
+    crowd them out at the switch.
+
+    :param dp: datapath description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :param eth_type: ethertype to match
+    :type eth_type: int
+
+    :param meter_id: meter to cap the rate of matched packets with
+    :type meter_id: int
+
+    :param eth_dst: destination MAC to match, e.g. broadcast only
+    :type eth_dst: str
+
+    :param table: flow table to install this rule in
+    :type table: int
+
+    :return: message to send to the switch
+    :type: `parser.OFPFlowMod`
+    '''
+    if eth_dst is None:
+        match = parser.OFPMatch(eth_type=eth_type)
+    else:
+        match = parser.OFPMatch(eth_type=eth_type, eth_dst=eth_dst)
+    actions = [parser.OFPActionOutput(ofp.OFPP_CONTROLLER,
+                                      ofp.OFPCML_NO_BUFFER)]
+    msg = parser.OFPFlowMod(datapath=dp,
+                            priority=P_LOW,
+                            table_id=table,
+                            match=match,
+                            instructions=compose(actions, meter_id=meter_id))
+    return msg
+
+
+def meter_packet_in(dp, meter_id, rate, burst=0, command=ofp.OFPMC_ADD):
+    '''
+    Produce a MeterMod that drops packets over a rate, for rules that
+    send packets to the controller.
+
+    :param dp: datapath description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :param meter_id: meter identifier
+    :type meter_id: int
+
+    :param rate: packets per second let through
+    :type rate: int
+
+    :param burst: packets let through at once over the rate
+    :type burst: int
+
+    :param command: `ofp.OFPMC_ADD`, `ofp.OFPMC_MODIFY` or
+                    `ofp.OFPMC_DELETE`
+    :type command: int
+
+    :returns: meter mod message
+    :rtype: `parser.OFPMeterMod`
+    '''
+    flags = ofp.OFPMF_PKTPS
+    if burst:
+        flags |= ofp.OFPMF_BURST
+    bands = [parser.OFPMeterBandDrop(rate=rate, burst_size=burst)]
+    msg = parser.OFPMeterMod(dp, command, flags, meter_id, bands)
+    return msg
+
+
+def flow_arp_known(dp, dl_src, command=ofp.OFPFC_ADD):
+    '''
+    Produce a FlowMod for DEFAULT table that passes ARP requests of
+    a learned host on to ARP table, to be answered within the switch.
+
+    Requests of hosts not learned yet miss this rule and go to the
+    controller, which learns the host from them.
+
+    :param dp: datapath description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :param dl_src: MAC address of the host
+    :type dl_src: str
+
+    :param command: `ofp.OFPFC_ADD` or `ofp.OFPFC_DELETE_STRICT`
+    :type command: int
+
+    :returns: flow mod message
+    :rtype: `parser.OFPFlowMod`
+    '''
+    match = parser.OFPMatch(eth_type=ethertypes.ETH_TYPE_ARP,
+                            arp_op=arp.ARP_REQUEST,
+                            eth_src=dl_src)
+    msg = parser.OFPFlowMod(datapath=dp,
+                            command=command,
+                            priority=P_HIGH,
+                            table_id=T_DEFAULT,
+                            match=match,
+                            out_port=ofp.OFPP_ANY,
+                            out_group=ofp.OFPG_ANY,
+                            instructions=compose(to_table=T_ARP))
+    return msg
+
+
+def flow_arp_reply(dp, nl_dst, dl_dst, command=ofp.OFPFC_ADD):
+    '''
+    Produce a FlowMod for ARP table that answers ARP requests for
+    an IP within the switch.
+
+    The request is turned into a reply in place and sent back out of
+    the port it came from. OpenFlow 1.4 has no action to copy a field
+    into another one, requester addresses are moved into the target
+    fields with Nicira register moves, as supported by Open vSwitch.
+
+    :param dp: datapath description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :param nl_dst: IP address to answer for
+    :type nl_dst: str
+
+    :param dl_dst: MAC address the IP resolves to
+    :type dl_dst: str
+
+    :param command: `ofp.OFPFC_ADD` or `ofp.OFPFC_DELETE_STRICT`
+    :type command: int
+
+    :returns: flow mod message
+    :rtype: `parser.OFPFlowMod`
+    '''
+    match = parser.OFPMatch(eth_type=ethertypes.ETH_TYPE_ARP,
+                            arp_op=arp.ARP_REQUEST,
+                            arp_tpa=nl_dst)
+    actions = [
+        parser.NXActionRegMove(src_field="eth_src", dst_field="eth_dst",
+                               n_bits=48),
+        parser.OFPActionSetField(eth_src=dl_dst),
+        parser.OFPActionSetField(arp_op=arp.ARP_REPLY),
+        parser.NXActionRegMove(src_field="arp_sha", dst_field="arp_tha",
+                               n_bits=48),
+        parser.NXActionRegMove(src_field="arp_spa", dst_field="arp_tpa",
+                               n_bits=32),
+        parser.OFPActionSetField(arp_sha=dl_dst),
+        parser.OFPActionSetField(arp_spa=nl_dst),
+        parser.OFPActionOutput(ofp.OFPP_IN_PORT),
+        ]
+    msg = parser.OFPFlowMod(datapath=dp,
+                            command=command,
+                            priority=P_HIGH,
+                            table_id=T_ARP,
+                            match=match,
+                            out_port=ofp.OFPP_ANY,
+                            out_group=ofp.OFPG_ANY,
+                            instructions=compose(actions))
     return msg
 
 
@@ -198,6 +396,266 @@ def flow_inbound(dp):
     return msg
 
 
+def group_select(dp, group_id, ports, command=ofp.OFPGC_ADD):
+    '''
+    Produce a GroupMod for a select group that spreads flows over
+    the given ports with equal weight.
+
+    Buckets watch their ports, so the switch stops using a bucket
+    as soon as its port goes down.
+
+    :param dp: datapath description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :param group_id: group identifier
+    :type group_id: int
+
+    :param ports: equal cost out ports, one bucket per port
+    :type ports: list of int
+
+    :param command: `ofp.OFPGC_ADD`, `ofp.OFPGC_MODIFY` or `ofp.OFPGC_DELETE`
+    :type command: int
+
+    :returns: group mod message
+    :rtype: `parser.OFPGroupMod`
+    '''
+    buckets = [parser.OFPBucket(weight=1,
+                                watch_port=port,
+                                actions=[parser.OFPActionOutput(port)])
+               for port in ports]
+    msg = parser.OFPGroupMod(dp, command, ofp.OFPGT_SELECT, group_id, buckets)
+    return msg
+
+
+def group_failover(dp, group_id, ports, command=ofp.OFPGC_ADD):
+    '''
+    Produce a GroupMod for a fast failover group that forwards to
+    the first of the given ports that is up.
+
+    :param dp: datapath description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :param group_id: group identifier
+    :type group_id: int
+
+    :param ports: out ports in order of preference, one bucket per port
+    :type ports: list of int
+
+    :param command: `ofp.OFPGC_ADD` or `ofp.OFPGC_MODIFY`
+    :type command: int
+
+    :returns: group mod message
+    :rtype: `parser.OFPGroupMod`
+    '''
+    buckets = [parser.OFPBucket(watch_port=port,
+                                actions=[parser.OFPActionOutput(port)])
+               for port in ports]
+    msg = parser.OFPGroupMod(dp, command, ofp.OFPGT_FF, group_id, buckets)
+    return msg
+
+
+def group_next_hops(dp, group_id, hops, command=ofp.OFPGC_ADD):
+    '''
+    Produce a GroupMod for the next hops towards a remote switch.
+
+    A single primary port with a backup becomes a fast failover group,
+    so the switch moves to the backup without waiting for the
+    controller. Equal cost ports already cover each other and stay
+    in a select group.
+
+    :param hops: primary out ports and backup out port or None,
+                 as produced by `TopologyGraph.diff`
+    :type hops: (tuple of int, int)
+
+    :returns: group mod message
+    :rtype: `parser.OFPGroupMod`
+    '''
+    ports, backup = hops
+    if backup is not None and len(ports) == 1:
+        return group_failover(dp, group_id, [ports[0], backup], command)
+    return group_select(dp, group_id, ports, command)
+
+
+def group_delete_all(dp):
+    '''
+    Produce a GroupMod that deletes every group of a switch, and every
+    flow forwarding to one.
+
+    :param dp: datapath description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :returns: group mod message
+    :rtype: `parser.OFPGroupMod`
+    '''
+    return parser.OFPGroupMod(dp, ofp.OFPGC_DELETE, ofp.OFPGT_ALL,
+                              ofp.OFPG_ALL, [])
+
+
+def flow_flush(dp, table=ofp.OFPTT_ALL):
+    '''
+    Produce a FlowMod that deletes every flow of a table.
+
+    :param dp: datapath description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :param table: table to flush, all of them by default
+    :type table: int
+
+    :returns: flow mod message
+    :rtype: `parser.OFPFlowMod`
+    '''
+    msg = parser.OFPFlowMod(datapath=dp,
+                            command=ofp.OFPFC_DELETE,
+                            table_id=table,
+                            match=parser.OFPMatch(),
+                            out_port=ofp.OFPP_ANY,
+                            out_group=ofp.OFPG_ANY)
+    return msg
+
+
+def flow_to_group(dp, dpid, group_id, command=ofp.OFPFC_ADD):
+    '''
+    Produce a FlowMod for TRANSIT table that matches PBB packets
+    destined to a remote switch and hands them to a group.
+
+    :param dp: datapath description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :param dpid: destination switch id, matched as PBB dl_dst
+    :type dpid: int
+
+    :param group_id: group to forward matched packets to
+    :type group_id: int
+
+    :param command: `ofp.OFPFC_ADD` or `ofp.OFPFC_DELETE_STRICT`
+    :type command: int
+
+    :returns: flow mod message
+    :rtype: `parser.OFPFlowMod`
+    '''
+    switch_mac = int_to_mac(dpid)
+    match = parser.OFPMatch(eth_type=0x88E7, eth_dst=switch_mac)
+    actions = [parser.OFPActionGroup(group_id)]
+    msg = parser.OFPFlowMod(datapath=dp,
+                            command=command,
+                            priority=P_LOW,
+                            table_id=T_TRANSIT,
+                            match=match,
+                            out_port=ofp.OFPP_ANY,
+                            out_group=ofp.OFPG_ANY,
+                            instructions=compose(actions))
+    return msg
+
+
+def flows_from_delta(dp, delta, group_of):
+    '''
+    Translate next hop changes of a switch into the minimal set of
+    messages to bring its TRANSIT table up to date.
+
+    New destinations get a group and a flow pointing to it, changed
+    ones only have their group modified, and removed ones only have
+    their group deleted, which removes the flow along with it.
+
+    :param dp: datapath description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :param delta: "added", "changed" and "removed" next hops per
+                  destination, as produced by `TopologyGraph.diff`
+    :type delta: {str: {int: (tuple of int, int)}}
+
+    :param group_of: maps destination switch id to its group id
+    :type group_of: callable
+
+    :returns: messages to send to the switch, in order
+    :rtype: list of `parser.OFPGroupMod` and `parser.OFPFlowMod`
+    '''
+    msgs = []
+    for dpid, hops in delta["added"].items():
+        group_id = group_of(dpid)
+        msgs.append(group_next_hops(dp, group_id, hops))
+        msgs.append(flow_to_group(dp, dpid, group_id))
+    for dpid, hops in delta["changed"].items():
+        msgs.append(group_next_hops(dp, group_of(dpid), hops,
+                                    ofp.OFPGC_MODIFY))
+    for dpid in delta["removed"]:
+        msgs.append(group_select(dp, group_of(dpid), [], ofp.OFPGC_DELETE))
+    return msgs
+
+
+def bundle(dp, bundle_id, msgs):
+    '''
+    Wrap modification messages into a bundle, which the switch applies
+    in order and all at once, or not at all if any of them fails.
+
+    :param dp: datapath description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :param bundle_id: bundle identifier, unique among open bundles
+                      of the switch
+    :type bundle_id: int
+
+    :param msgs: flow and group mods to apply
+    :type msgs: list of `parser.OFPFlowMod` and `parser.OFPGroupMod`
+
+    :returns: messages to send to the switch, in order
+    :rtype: list of `parser.OFPBundleCtrlMsg` and `parser.OFPBundleAddMsg`
+    '''
+    flags = ofp.OFPBF_ATOMIC | ofp.OFPBF_ORDERED
+    bundled = [parser.OFPBundleCtrlMsg(dp, bundle_id,
+                                       ofp.OFPBCT_OPEN_REQUEST, flags, [])]
+    bundled.extend(parser.OFPBundleAddMsg(dp, bundle_id, flags, msg, [])
+                   for msg in msgs)
+    bundled.append(parser.OFPBundleCtrlMsg(dp, bundle_id,
+                                           ofp.OFPBCT_COMMIT_REQUEST,
+                                           flags, []))
+    return bundled
+
+
+def unmetered(msg):
+    '''
+    Produce a copy of a FlowMod without its meter, for switches that
+    have no meters.
+
+    :param msg: flow mod message
+    :type msg: `parser.OFPFlowMod`
+
+    :returns: flow mod message, or None if `msg` has no meter
+    :rtype: `parser.OFPFlowMod`
+    '''
+    inst = [i for i in msg.instructions
+            if not isinstance(i, parser.OFPInstructionMeter)]
+    if len(inst) == len(msg.instructions):
+        return None
+    return parser.OFPFlowMod(datapath=msg.datapath,
+                             command=msg.command,
+                             priority=msg.priority,
+                             table_id=msg.table_id,
+                             match=msg.match,
+                             out_port=msg.out_port,
+                             out_group=msg.out_group,
+                             instructions=inst)
+
+
+def group_of_route(msg):
+    '''
+    Return the group a TRANSIT route message is about.
+
+    :param msg: message produced by `flows_from_delta`, or any other
+    :type msg: `parser.OFPGroupMod` or `parser.OFPFlowMod`
+
+    :returns: group id, or None if `msg` is not a route
+    :rtype: int
+    '''
+    if isinstance(msg, parser.OFPGroupMod):
+        return msg.group_id
+    if isinstance(msg, parser.OFPFlowMod) and msg.table_id == T_TRANSIT:
+        for inst in msg.instructions:
+            for action in getattr(inst, "actions", ()):
+                if isinstance(action, parser.OFPActionGroup):
+                    return action.group_id
+    return None
+
+
 def send_packet_out(dp, pkt, out_port, in_port=ofp.OFPP_CONTROLLER):
     """
     Produce a message for a switch to send the provided
@@ -226,3 +684,16 @@ def send_packet_out(dp, pkt, out_port, in_port=ofp.OFPP_CONTROLLER):
                               actions=actions,
                               data=pkt)
     return msg
+
+
+def port_desc_request(dp):
+    """
+    Produce a request for description of all ports of a switch.
+
+    :param dp: datapath description
+    :type dp: `ryu.controller.controller.Datapath`
+
+    :returns: message to be sent to switch
+    :rtype: `parser.OFPPortDescStatsRequest`
+    """
+    return parser.OFPPortDescStatsRequest(dp, 0, ofp.OFPP_ANY)
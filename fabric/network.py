@@ -1,8 +1,21 @@
 """
 This module contains everything related to network topology processing
 """
+from array import array
 from collections import defaultdict
-import heapq
+import sys
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from fabric.cow import DELETED, FrozenMap
+from fabric.pqdict import PQDict
+
+
+REF_BANDWIDTH = 100000000  #: Speed in kbps of a link that costs 1
+DEFAULT_COST = 1  #: Cost of a link with unknown port speed
 
 
 class Network(object):
@@ -11,10 +24,30 @@ class Network(object):
     Container for all network state
     """
 
-    def __init__(self):
+    def __init__(self, incremental=True, deferred=False, dense=False,
+                 host_holdoff=1.0):
         self.topo = TopologyGraph(lambda: None)  # (src_dpid, dst_dpid) => port_no
-        self.ip_to_mac = defaultdict(lambda: None)  # IP => MAC
-        self.mac_to_port = defaultdict(lambda: None)  # MAC => (dpid,port_no)
+        self.ip_to_mac = AddressTable()  # IP => MAC
+        self.mac_to_port = HostTable()  # MAC => (dpid,port_no)
+        self.incremental = incremental  #: Reroute only affected pairs
+        self.topo.deferred = deferred  #: Hold off rerouting until `flush`
+        if dense:
+            # only bulk rebuilds go through the solver, so without
+            # deferred rerouting all pairs would be wasted on a tree or two
+            if not deferred:
+                raise ValueError("Dense backend requires deferred rerouting")
+            from fabric import dense as backend
+            self.topo.solver = backend.spf_trees
+        self.pending = 0  #: Topology events since the last `flush`
+        self.absorbed = 0  #: Topology events coalesced by the last `flush`
+        self._changed = set()  # pairs changed by pending events
+        self._settled = 0  # topology version of the last pending event
+        self.port_speed = {}  # (dpid, port_no) => kbps
+        self.metrics = {}  # (dpid, port_no) => configured link cost
+        self.unconfirmed = set()  #: Restored dpids and links not seen live
+        self._snapshot = None  # latest `NetworkSnapshot`
+        self.host_holdoff = host_holdoff  #: Seconds a host stays put for
+        self._learned_at = {}  # MAC => time host was learned or moved
 
     def mac_of_ip(self, ip):
         """
@@ -40,6 +73,76 @@ class Network(object):
         """
         return self.mac_to_port[mac]
 
+    def macs_on(self, dpid, port_no=None):
+        """
+        Returns MACs seen behind a given dpid or (dpid, port_no)
+
+        :param dpid: datapath id for a lookup
+        :type dpid: int
+
+        :param port_no: port number to narrow down the lookup
+        :type port_no: int
+
+        :returns: MAC addresses
+        :rtype: set of str
+        """
+        if port_no is None:
+            return set(self.mac_to_port.by_dpid.get(dpid, ()))
+        return set(self.mac_to_port.by_port.get((dpid, port_no), ()))
+
+    def ips_of_mac(self, mac):
+        """
+        Returns IPs associated with a given MAC
+
+        :param mac: MAC for a lookup
+        :type mac: str
+
+        :returns: IP addresses
+        :rtype: set of str
+        """
+        return set(self.ip_to_mac.by_mac.get(mac, ()))
+
+    def learn_host(self, mac, dpid, port_no, ip=None, now=0.0):
+        """
+        Store location of a host and its IP if known
+
+        Fabric ports, i.e. ones with a peer switch, are ignored, and so
+        is a host moving again within `host_holdoff` of its last move.
+
+        :param mac: MAC address of the host
+        :type mac: str
+
+        :param dpid: datapath id of the switch the host is behind
+        :type dpid: int
+
+        :param port_no: port the host is behind
+        :type port_no: int
+
+        :param ip: IP address of the host
+        :type ip: str
+
+        :param now: current time
+        :type now: float
+
+        :returns: True if the host is new or has moved
+        :rtype: bool
+        """
+        if self.topo.peers_on(dpid, port_no):
+            return False
+        location = (dpid, port_no)
+        old = self.mac_to_port[mac]
+        moved = old != location
+        learned_at = self._learned_at.get(mac)
+        if moved and learned_at is not None and \
+                now - learned_at < self.host_holdoff:
+            return False
+        if moved:
+            self.mac_to_port[mac] = location
+            self._learned_at[mac] = now
+        if ip is not None and self.ip_to_mac[ip] != mac:
+            self.ip_to_mac[ip] = mac
+        return moved
+
     def add_peer(self, dpid, peer, port_no):
         """
         Store new peering information
@@ -52,9 +155,118 @@ class Network(object):
 
         :param port_no: recieving port number
         :type port_no: int
+
+        :returns: (src, dst) pairs whose path has changed
+        :rtype: set of (int, int)
         """
+        self.unconfirmed.discard((dpid, peer))
+        cost = self.link_cost(dpid, port_no)
+        if self.incremental:
+            return self._settle(self.topo.add_link(dpid, peer, port_no, cost))
+        old_port_no = self.topo.get((dpid, peer))
+        if old_port_no == port_no and \
+                self.topo.costs.get(dpid, {}).get(peer) == cost:
+            return self._settle(set())
         self.topo[dpid, peer] = port_no
-        self.topo.run_spf()
+        self.topo.costs[dpid][peer] = cost
+        # trees alone don't tell of new out ports and backup next hops
+        changed = self.topo.run_spf() | self.topo._alternates(dpid)
+        if old_port_no not in (None, port_no):
+            changed |= self.topo._moved(dpid, peer)
+        return self._settle(changed)
+
+    def remove_peer(self, dpid, peer):
+        """
+        Forget peering information, e.g. once the peer went silent
+
+        :param dpid: datapath id of the reporting switch
+        :type dpid: int
+
+        :param peer: datapath id of the peer
+        :type peer: int
+
+        :returns: (src, dst) pairs whose path has changed
+        :rtype: set of (int, int)
+        """
+        self.unconfirmed.discard((dpid, peer))
+        if self.incremental:
+            return self._settle(self.topo.remove_link(dpid, peer))
+        if self.topo.get((dpid, peer)) is None:
+            return set()
+        del self.topo[dpid, peer]
+        return self._settle(self.topo.run_spf() |
+                            self.topo._alternates(dpid))
+
+    def link_cost(self, dpid, port_no):
+        """
+        Return cost of a link going out of the given port.
+
+        Configured metric takes precedence, otherwise the cost is
+        derived from the port speed the same way OSPF does it.
+
+        :param dpid: datapath id of the switch
+        :type dpid: int
+
+        :param port_no: out port of the link
+        :type port_no: int
+
+        :returns: link cost, at least 1
+        :rtype: int
+        """
+        cost = self.metrics.get((dpid, port_no))
+        if cost is not None:
+            return cost
+        speed = self.port_speed.get((dpid, port_no))
+        if not speed:
+            return DEFAULT_COST
+        return max(1, REF_BANDWIDTH // speed)
+
+    def set_port_speed(self, dpid, port_no, speed):
+        """
+        Store current port speed and update cost of the link on it.
+
+        :param dpid: datapath id of the switch
+        :type dpid: int
+
+        :param port_no: port number
+        :type port_no: int
+
+        :param speed: current port speed in kbps
+        :type speed: int
+
+        :returns: (src, dst) pairs whose path has changed
+        :rtype: set of (int, int)
+        """
+        self.port_speed[dpid, port_no] = speed
+        return self._update_cost(dpid, port_no)
+
+    def set_metric(self, dpid, port_no, cost=None):
+        """
+        Configure cost of the link going out of the given port.
+
+        :param dpid: datapath id of the switch
+        :type dpid: int
+
+        :param port_no: port number
+        :type port_no: int
+
+        :param cost: link cost; speed based cost is restored if None
+        :type cost: int
+
+        :returns: (src, dst) pairs whose path has changed
+        :rtype: set of (int, int)
+        """
+        if cost is None:
+            self.metrics.pop((dpid, port_no), None)
+        else:
+            self.metrics[dpid, port_no] = cost
+        return self._update_cost(dpid, port_no)
+
+    def _update_cost(self, dpid, port_no):
+        for src, peer in self.topo.links_of(dpid, port_no):
+            if src == dpid:
+                return self.add_peer(dpid, peer, port_no)
+        return set()
 
     def add_switch(self, dpid):
         """
@@ -62,18 +274,38 @@ class Network(object):
 
         :param dpid: datapath id of the reporting switch
         :type dpid: int
+
+        A connecting switch has its groups and flows wiped, so all its
+        routes are reported again, whether it is new, reconnecting or
+        restored by `fabric.warmstart`. These are reported right away
+        even if rerouting is deferred, from the trees at hand, as the
+        switch has no routes at all until then.
+
+        :returns: (src, dst) pairs whose path has changed
+        :rtype: set of (int, int)
         """
-        self.topo.switches.add(dpid)
+        self.topo.fib.pop(dpid, None)
+        resync = set((dpid, dst) for dst in self.topo.switches
+                     if dst != dpid)
+        if dpid in self.unconfirmed:
+            self.unconfirmed.discard(dpid)
+            return resync
+        if self.incremental:
+            return self._settle(self.topo.add_switch(dpid)) | resync
+        topo = self.topo
+        topo.switches.add(dpid)
+        changed = topo.run_spf()
+        for root in topo._trees:
+            if root != dpid and topo._cost(root, dpid) is not None:
+                changed.add((root, dpid))
+        return self._settle(changed) | resync
 
     def udl(self, dpid, peer):
         """
         Check if discovered link is unidirectional
         """
-        assert self.topo[dpid, peer] is not None
-        if self.topo[peer, dpid]:
-            return False
-        else:
-            return True
+        assert peer in self.topo.neighbors(dpid)
+        return dpid not in self.topo.neighbors(peer)
 
     def purge(self, dpid, port_no=None):
         """
@@ -85,40 +317,291 @@ class Network(object):
         :param port_no: port number to narrow down the cleanse;
                         all ports will be removed if not given
         :type port_no: int
+
+        :returns: (src, dst) pairs whose path has changed
+        :rtype: set of (int, int)
+        """
+        self.purge_hosts(self.macs_on(dpid, port_no))
+
+        changed = set()
+        rewired = set()  # switches that lost links in full recompute mode
+        for key in self.topo.links_of(dpid, port_no):
+            if self.incremental:
+                changed |= self.topo.remove_link(*key)
+            else:
+                del self.topo[key]
+                rewired.add(key[0])
+
+        if not port_no:
+            self.unconfirmed.discard(dpid)
+            if self.incremental:
+                changed |= self.topo.remove_switch(dpid)
+            else:
+                self.topo.switches.discard(dpid)
+
+        if not self.incremental:
+            changed = self.topo.run_spf()
+            for src in rewired & self.topo.switches:
+                changed |= self.topo._alternates(src)
+        return self._settle(changed)
+
+    def purge_hosts(self, macs):
         """
-        purge_macs = []
-        for mac, item in self.mac_to_port.items():
-            table_dpid, table_port_no = item
-            if table_dpid == dpid:
-                if not port_no or table_port_no == port_no:
-                    purge_macs.add(mac)
-                    del self.mac_to_port[mac]
+        Cleanse given hosts with their IPs from host tables
 
-        for ip, mac in self.ip_to_mac.items():
-            if mac in purge_macs:
+        :param macs: MAC addresses of the hosts
+        :type macs: iterable of str
+        """
+        for mac in macs:
+            self.mac_to_port.pop(mac, None)
+            self._learned_at.pop(mac, None)
+            for ip in self.ips_of_mac(mac):
                 del self.ip_to_mac[ip]
 
-        for key, table_port_no in self.topo.items():
-            table_sdpid, table_ddpid = key
-            if table_sdpid == dpid or table_ddpid == dpid:
-                if not port_no or table_port_no == port_no:
-                    del self.topo[key]
+    def validate(self):
+        """
+        Purge restored switches and links that haven't been seen live
+        since the restore.
 
-        if not port_no:
-            self.topo.switches.pop(dpid)
+        :returns: (src, dst) pairs whose path has changed
+        :rtype: set of (int, int)
+        """
+        links = [key for key in self.unconfirmed if isinstance(key, tuple)]
+        changed = set()
+        rewired = set()  # switches that lost links in full recompute mode
+        for src, dst in links:
+            port_no = self.topo.get((src, dst))
+            if self.incremental:
+                changed |= self.topo.remove_link(src, dst)
+            elif port_no is not None:
+                del self.topo[src, dst]
+                rewired.add(src)
+        for dpid in self.unconfirmed.difference(links):
+            changed |= self.purge(dpid)
+        self.unconfirmed.clear()
+        if not self.incremental:
+            changed |= self.topo.run_spf()
+            for src in rewired & self.topo.switches:
+                changed |= self.topo._alternates(src)
+        return self._settle(changed)
+
+    def snapshot(self):
+        """
+        Return an immutable view of the current state.
+
+        Snapshots share unchanged parts of their tables with the previous
+        one, taking a snapshot costs O(changes) since the last one.
+        Tables only start tracking changes on the first call.
+
+        :returns: state as of now, the previous snapshot if nothing
+                  has changed since
+        :rtype: `NetworkSnapshot`
+        """
+        topo, prev = self.topo, self._snapshot
+        tables = (topo, self.mac_to_port, self.ip_to_mac)
+        if prev is None:
+            for table in tables:
+                table.touched = set()
+            links = FrozenMap((key, port_no) for key, port_no in topo.items()
+                              if port_no is not None)
+            costs = FrozenMap(((src, dst), cost)
+                              for src, peers in topo.costs.items()
+                              for dst, cost in peers.items())
+            self._snapshot = NetworkSnapshot(
+                1, frozenset(topo.switches), links, costs,
+                FrozenMap(self.mac_to_port), FrozenMap(self.ip_to_mac), topo)
+            return self._snapshot
+
+        trees = [(root, tree) for root, tree in topo._trees.items()
+                 if root not in topo._stale]
+        trees_changed = prev.stale != topo._stale or \
+            len(trees) != len(prev._trees) or any(
+                prev._trees.get(root) is not tree for root, tree in trees)
+        if not trees_changed and not any(table.touched for table in tables) \
+                and topo.switches == prev.switches:
+            return prev
+
+        links, costs = {}, {}
+        for src, dst in topo.touched:
+            port_no = topo.get((src, dst))
+            if port_no is None:
+                links[src, dst] = costs[src, dst] = DELETED
+            else:
+                links[src, dst] = port_no
+                costs[src, dst] = topo.costs[src][dst]
+        hosts = dict((mac, self.mac_to_port.get(mac, DELETED))
+                     for mac in self.mac_to_port.touched)
+        addresses = dict((ip, self.ip_to_mac.get(ip, DELETED))
+                         for ip in self.ip_to_mac.touched)
+        for table in tables:
+            table.touched.clear()
+
+        switches = prev.switches
+        if topo.switches != switches:
+            switches = frozenset(topo.switches)
+        self._snapshot = NetworkSnapshot(
+            prev.version + 1, switches, prev.links.evolve(links),
+            prev.costs.evolve(costs), prev.mac_to_port.evolve(hosts),
+            prev.ip_to_mac.evolve(addresses), topo)
+        return self._snapshot
+
+    def flush(self, trees=None, version=None):
+        """
+        Reroute everything that pending topology events have affected.
+
+        Number of events coalesced into this run is kept in `absorbed`.
+
+        :param trees: trees computed off `self.topo.snapshot()`
+        :type trees: {dpid: tree}
+
+        :param version: version of the snapshot
+        :type version: int
+
+        :returns: (src, dst) pairs whose path has changed since
+                  the previous flush, or None if `trees` were discarded
+                  as topology has changed since the snapshot
+        :rtype: set of (int, int)
+        """
+        changed = self.topo.flush(trees, version)
+        if changed is None:
+            return None
+        changed |= self._changed
+        self._changed = set()
+        self.absorbed, self.pending = self.pending, 0
+        return changed
+
+    def _settle(self, changed):
+        """
+        Pass changed pairs through or hold them until `flush`
+        if rerouting is deferred.
+
+        Only events that changed the topology or some pairs count
+        as pending, repeated announcements of known links don't.
+        """
+        if not self.topo.deferred:
+            return changed
+        if changed or self.topo.version != self._settled:
+            self._settled = self.topo.version
+            self._changed |= changed
+            self.pending += 1
+        return set()
 
 
 class TopologyGraph(defaultdict):
     """
     Topology graph with network related helpers.
 
-    Stores unidirectional (peerA, PeerB) => out_port mappings.
+    Stores unidirectional (peerA, PeerB) => out_port mappings,
+    with link costs kept alongside in `costs`. Every change is mirrored
+    into per switch adjacency and a port to peer index, so queries about
+    one switch or port cost O(degree). Missing links read as None
+    without being stored.
+
+    Every switch is the root of a shortest path tree, computed with
+    a single search over a persistent adjacency index. Besides the best
+    path, the search collects all equal cost next hops of the root.
+    Trees are kept up to date incrementally by `add_link`, `remove_link`,
+    `add_switch` and `remove_switch`, which rebuild only the trees
+    a change can affect. `run_spf` rebuilds everything.
+
+    With `deferred` set, changes only mark trees as stale and
+    the rebuild of all of them happens at once on `flush`. Stale trees
+    may also be computed elsewhere from a `snapshot` and handed back
+    to `flush`, as long as `version` hasn't moved on in the meantime.
+
+    Bulk rebuilds by `run_spf` and `flush` go through `solver`, which
+    may be swapped for `fabric.dense.spf_trees` on large fabrics.
+    Incremental rebuilds always search tree by tree, so that only
+    pays off together with `deferred`.
+
+    Next to equal cost next hops, every switch gets a loop-free alternate
+    next hop per destination from `backup_hop`, taken over by the switch
+    itself when the primary port goes down.
+
+    Changed pairs are turned into per switch next hop changes by `diff`,
+    against `fib`, the next hops it has reported before.
+
+    Trees are stored compactly: every dpid gets a position in `array`
+    rows of path cost, previous hop and next hops per root, where next
+    hops are ids of interned tuples shared by all trees. Paths are not
+    stored at all, `paths` walks them back from the trees on access.
     """
 
     def __init__(self, *args, **kwargs):
         self.switches = set()
+        self.paths = PathTable(self)  # (src, dst) => [dpid, ...]
+        self._adj = defaultdict(dict)  # peerA => {peerB: out_port}
+        self._peers_in = defaultdict(set)  # peerB => {peerA, ...}
+        self._ports = defaultdict(set)  # (peerA, out_port) => {peerB, ...}
+        self.costs = defaultdict(dict)  # peerA => {peerB: cost}
+        self._index = {}  # dpid => position in tree rows
+        self._dpids = []  # position in tree rows => dpid
+        self._trees = {}  # src => (cost row, previous hop row, next hops row)
+        self._hop_sets = [()]  # next hops id => tuple of dpids
+        self._hop_ids = {frozenset(): 0}  # set of dpids => next hops id
+        self.deferred = False
+        self._stale = set()  # roots waiting for `flush`
+        self._relinked = set()  # links with out port changed before `flush`
+        self._rewired = set()  # switches with links changed before `flush`
+        self.version = 0  #: Bumped on every change of links or switches
+        self.solver = spf_trees  #: Computes trees for many roots at once
+        self.fib = defaultdict(dict)  # dpid => {dst: (ports, backup)} diffed
+        self.touched = None  #: Links changed since `Network.snapshot`
         super(TopologyGraph, self).__init__(*args, **kwargs)
 
+    def __missing__(self, key):
+        return None
+
+    def __setitem__(self, key, port_no):
+        if port_no is not None or self.get(key) is not None:
+            self.version += 1
+        super(TopologyGraph, self).__setitem__(key, port_no)
+        if self.touched is not None:
+            self.touched.add(key)
+        src, dst = key
+        self._unlink(src, dst)
+        if port_no is not None:
+            self._adj[src][dst] = port_no
+            self.costs[src].setdefault(dst, DEFAULT_COST)
+            self._peers_in[dst].add(src)
+            self._ports[src, port_no].add(dst)
+        else:
+            self.costs.get(src, {}).pop(dst, None)
+
+    def __delitem__(self, key):
+        super(TopologyGraph, self).__delitem__(key)
+        self.version += 1
+        if self.touched is not None:
+            self.touched.add(key)
+        src, dst = key
+        self._unlink(src, dst)
+        self.costs.get(src, {}).pop(dst, None)
+
+    def _unlink(self, src, dst):
+        """
+        Drop a link from adjacency indexes, keeping its cost.
+        """
+        peers = self._adj.get(src)
+        if peers is None or dst not in peers:
+            return
+        port_no = peers.pop(dst)
+        if not peers:
+            del self._adj[src]
+        for index, key, item in ((self._peers_in, dst, src),
+                                 (self._ports, (src, port_no), dst)):
+            items = index.get(key)
+            if items is not None:
+                items.discard(item)
+                if not items:
+                    del index[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super(TopologyGraph, self).pop(key, *default)
+        port_no = self[key]
+        del self[key]
+        return port_no
+
     @property
     def edges(self):
         """
@@ -127,14 +610,209 @@ class TopologyGraph(defaultdict):
         :returns: unidirectional internal links that are discovered so far
         :rtype: list of (peerA, peerB)
         """
-        return self.keys()
+        return [key for key, port_no in self.items() if port_no is not None]
 
     def run_spf(self):
-        lst = [(a, b) for a in self.switches for b in self.switches if a != b]
-        self.paths = defaultdict(lambda: None)
-        for src, dst in lst:
-            self.paths[src, dst] = self.dijkstra(src, dst)
-        print(self.paths)
+        """
+        Rebuild shortest path trees of all switches from scratch.
+
+        Trees of switches that are gone are dropped, and pairs towards
+        them are reported along with the rerouted ones.
+
+        This is one search per switch, about a second on a 20 spine
+        x 480 leaf fabric, most of it in `uniform_trees` and `_compact`.
+        Topology events reroute only the trees they affect.
+
+        :returns: (src, dst) pairs whose path has changed
+        :rtype: set of (int, int)
+        """
+        gone = [root for root in self._trees if root not in self.switches]
+        changed = set((root, dpid) for root in self._trees for dpid in gone
+                      if root != dpid and self._cost(root, dpid) is not None)
+        for root in gone:
+            self.fib.pop(root, None)
+            self._forget(root)
+        return changed | self._reroute(self.switches, bulk=True)
+
+    def snapshot(self):
+        """
+        Return a copy of everything needed to compute stale trees
+        with `spf_trees`, away from this graph.
+
+        :returns: version, link costs and roots of stale trees
+        :rtype: (int, {dpid: {dpid: int}}, list of int)
+        """
+        costs = dict((src, dict(peers))
+                     for src, peers in self.costs.items() if peers)
+        return self.version, costs, list(self._stale & self.switches)
+
+    def flush(self, trees=None, version=None):
+        """
+        Rebuild trees marked as stale while rerouting was deferred.
+
+        :param trees: trees computed by `spf_trees` from a `snapshot`;
+                      computed in place if not given
+        :type trees: {dpid: tree}
+
+        :param version: `version` of the snapshot `trees` come from
+        :type version: int
+
+        :returns: (src, dst) pairs whose path has changed,
+                  or None if `trees` are out of date and were discarded
+        :rtype: set of (int, int)
+        """
+        if trees is not None and version != self.version:
+            return None
+        stale, self._stale = self._stale & self.switches, set()
+        if trees is None and stale:
+            trees = self.solver(self.costs, list(stale))
+        changed = self._rebuild(stale, trees)
+        for src, dst in self._relinked:
+            if self.get((src, dst)) is not None:
+                changed |= self._crossing(src, dst)
+        self._relinked.clear()
+        for src in self._rewired & self.switches:
+            changed.update((src, dpid) for dpid in self.switches
+                           if dpid != src)
+        self._rewired.clear()
+        return changed
+
+    def add_link(self, src, dst, port_no, cost=DEFAULT_COST):
+        """
+        Store a link and rebuild only the trees it can affect.
+
+        A new or cheaper link (src, dst) changes the tree of a switch
+        only if that switch reaches `src` plus the link cost cheaper than
+        it reaches `dst`. A more expensive link changes only the trees
+        that were using it.
+
+        :param src: dpid of the switch the link starts at
+        :type src: int
+
+        :param dst: dpid of the peer
+        :type dst: int
+
+        :param port_no: out port of `src` towards `dst`
+        :type port_no: int
+
+        :param cost: cost of the link
+        :type cost: int
+
+        :returns: (src, dst) pairs whose path or out ports have changed
+        :rtype: set of (int, int)
+        """
+        old_port_no = self.get((src, dst))
+        old_cost = self.costs.get(src, {}).get(dst)
+        if old_port_no is not None and old_cost == cost:
+            if old_port_no == port_no:
+                return set()
+            self[src, dst] = port_no
+            return self._moved(src, dst) | self._alternates(src)
+
+        stale = set()
+        if old_port_no is not None and cost > old_cost:
+            stale.update(self._using(src, dst))
+        self[src, dst] = port_no
+        self.costs[src][dst] = cost
+        for root in self._trees:
+            to_src = self._cost(root, src)
+            if to_src is None:
+                continue
+            to_dst = self._cost(root, dst)
+            if to_dst is None or to_src + cost <= to_dst:
+                stale.add(root)
+        changed = self._reroute(stale)
+        if old_port_no not in (None, port_no):
+            changed |= self._moved(src, dst)
+        return changed | self._alternates(src)
+
+    def remove_link(self, src, dst):
+        """
+        Forget a link and rebuild only the trees that were using it.
+
+        :param src: dpid of the switch the link starts at
+        :type src: int
+
+        :param dst: dpid of the peer
+        :type dst: int
+
+        :returns: (src, dst) pairs whose path has changed
+        :rtype: set of (int, int)
+        """
+        if self.get((src, dst)) is None:
+            return set()
+        stale = self._using(src, dst)
+        del self[src, dst]
+        if self.deferred:
+            self._relinked.add((src, dst))
+        return self._reroute(stale) | self._alternates(src)
+
+    def add_switch(self, dpid):
+        """
+        Store new switch id and compute paths to and from it.
+
+        :param dpid: datapath id of the switch
+        :type dpid: int
+
+        :returns: (src, dst) pairs whose path has changed
+        :rtype: set of (int, int)
+        """
+        if dpid in self.switches:
+            return set()
+        self.switches.add(dpid)
+        self.version += 1
+        changed = self._reroute([dpid])
+        for root in self._trees:
+            if root != dpid and self._cost(root, dpid) is not None:
+                changed.add((root, dpid))
+        return changed
+
+    def remove_switch(self, dpid):
+        """
+        Forget a switch with all its links and paths.
+
+        :param dpid: datapath id of the switch
+        :type dpid: int
+
+        :returns: (src, dst) pairs whose path has changed
+        :rtype: set of (int, int)
+        """
+        changed = set()
+        for root in self._trees:
+            if root == dpid:
+                continue
+            if self._cost(root, dpid) is not None:
+                changed.add((root, dpid))
+            if dpid in self._trees and self._cost(dpid, root) is not None:
+                changed.add((dpid, root))
+
+        stale = set()
+        for src, dst in self.links_of(dpid):
+            stale.update(self._using(src, dst))
+            del self[src, dst]
+            if self.deferred:
+                self._relinked.add((src, dst))
+            if src != dpid:
+                changed |= self._alternates(src)
+
+        self.switches.discard(dpid)
+        self.version += 1
+        self.fib.pop(dpid, None)
+        self._forget(dpid)
+        stale.discard(dpid)
+        changed |= self._reroute(stale)
+        return changed
+
+    def spf_tree(self, src):
+        """
+        Compute the shortest path tree rooted at a given switch.
+
+        :param src: dpid of the root switch
+        :type src: int
+
+        :returns: see `shortest_path_tree`
+        """
+        return shortest_path_tree(self.costs, src)
 
     def dijkstra(self, src, dst):
         """
@@ -149,29 +827,857 @@ class TopologyGraph(defaultdict):
         :returns: best path to dst from src
         :rtype: list of int
         """
-        graph = defaultdict(list)
-        for a, b in self.edges:
-            graph[a].append(b)
-
-        queue = [(0, src, [])]
-        seen = set()
-
-        while queue:
-            cost, a, path = heapq.heappop(queue)
-            if a not in seen:
-                seen.add(a)
-                path = path + [a]  # FIXME: Not the most CPU effective way
-                if a == dst:
-                    return path  # Success
-                for b in graph[a]:
-                    if b not in seen:
-                        heapq.heappush(queue, (cost+1, b, path))
-        return None  # Failure
-
-    def path_to_port(self, path, G, count=0):
+        if src not in self._trees:
+            self._grow(src)
+        return self._path(src, dst)
+
+    def next_hops(self, src, dst):
+        """
+        Return out ports of all equal cost next hops between two switches.
+
+        :param src: dpid of the starting switch
+        :type src: int
+
+        :param dst: dpid of the target switch
+        :type dst: int
+
+        :returns: sorted out ports of `src`, empty if `dst` is unreachable
+        :rtype: tuple of int
+        """
+        if src not in self._trees:
+            self._grow(src)
+        ports = self._adj.get(src, {})
+        return tuple(sorted(ports[peer] for peer in self._hops(src, dst)))
+
+    def backup_hop(self, src, dst, peers=None):
+        """
+        Return out port of a loop-free alternate next hop between
+        two switches.
+
+        A peer qualifies if it is not the primary next hop and its own
+        best path to `dst` doesn't come back through `src`:
+        cost(peer, dst) < cost(peer, src) + cost(src, dst).
+        The cheapest of those is taken. Pairs with several equal cost
+        next hops get none, the switch balances over them instead and
+        `fabric.flows.group_next_hops` has no use for a backup there.
+
+        :param src: dpid of the starting switch
+        :type src: int
+
+        :param dst: dpid of the target switch
+        :type dst: int
+
+        :param peers: `_peer_rows` of `src` when asked for many pairs
+        :type peers: list of tuple
+
+        :returns: out port of `src` or None if there is no alternate
+        :rtype: int
+        """
+        if src not in self._trees:
+            self._grow(src)
+        primary = self._hops(src, dst)
+        if len(primary) != 1:
+            return None
+        to_dst = self._cost(src, dst)
+        if peers is None:
+            peers = self._peer_rows(src)
+
+        i = self._index[dst]
+        best = None
+        for peer, cost, port_no, row, peer_to_src in peers:
+            if peer in primary or i >= len(row) or row[i] < 0:
+                continue
+            if peer_to_src is None or row[i] < peer_to_src + to_dst:
+                candidate = (cost + row[i], port_no)
+                if best is None or candidate < best:
+                    best = candidate
+        return best[1] if best else None
+
+    def _peer_rows(self, src):
+        """
+        Return (peer, cost, out port, cost row, cost to `src`) of every
+        peer of `src` with a tree, what `backup_hop` needs of them for
+        any destination.
+        """
+        j = self._index[src]
+        peers = []
+        for peer, cost in self.costs.get(src, {}).items():
+            if peer not in self._trees:
+                continue
+            row = self._trees[peer][0]
+            peer_to_src = row[j] if j < len(row) and row[j] >= 0 else None
+            peers.append((peer, cost, self._adj[src][peer], row,
+                          peer_to_src))
+        return peers
+
+    def diff(self, pairs):
+        """
+        Compare next hops of the given pairs against `fib` and update it.
+
+        :param pairs: (src, dst) pairs reported as changed
+        :type pairs: iterable of (int, int)
+
+        :returns: out ports of primary next hops and of the backup one
+                  that were "added", "removed" or "changed" on every
+                  affected switch
+        :rtype: {dpid: {str: {dst: (tuple of int, int)}}}
+        """
+        delta = {}
+        peers = {}
+        for src, dst in pairs:
+            if src in self.switches and dst in self.switches:
+                hops = self.next_hops(src, dst)
+                rows = peers.get(src)
+                if rows is None:
+                    rows = peers[src] = self._peer_rows(src)
+                new = (hops, self.backup_hop(src, dst, rows))
+            else:
+                new = ((), None)
+            fib = self.fib[src]
+            old = fib.get(dst, ((), None))
+            if old == new:
+                continue
+
+            entry = delta.get(src)
+            if entry is None:
+                entry = delta[src] = {"added": {}, "removed": {},
+                                      "changed": {}}
+            if not new[0]:
+                entry["removed"][dst] = old
+                del fib[dst]
+            elif not old[0]:
+                entry["added"][dst] = fib[dst] = new
+            else:
+                entry["changed"][dst] = fib[dst] = new
+        return delta
+
+    def unroute(self, src, dst):
+        """
+        Forget next hops reported for a pair, e.g. as the switch has
+        rejected them, so that `diff` reports them as added again.
+        """
+        fib = self.fib.get(src)
+        if fib is not None:
+            fib.pop(dst, None)
+
+    def path_to_port(self, path, G=None, count=0):
+        """
+        Pair every hop of a path with its out port.
+
+        :param path: path as found in `paths`
+        :type path: list of int
+
+        :param G: peerA => {peerB: out_port}, this graph's if not given
+        :type G: dict
+
+        :returns: (dpid, out_port) for every hop but the last
+        :rtype: list of (int, int)
+        """
+        if G is None:
+            G = self._adj
         newPath = []
         while count < (len(path) - 1):
             src, dst = path[count], path[count + 1]
             newPath.append((src, G[src][dst]))
             count += 1
         return newPath
+
+    def neighbors(self, dpid):
+        """
+        Return peers a switch has links to.
+
+        :param dpid: datapath id of the switch
+        :type dpid: int
+
+        :returns: out port towards every peer
+        :rtype: {int: int}
+        """
+        return dict(self._adj.get(dpid, {}))
+
+    def peers_on(self, dpid, port_no):
+        """
+        Return peers reached over a port of a switch.
+
+        :param dpid: datapath id of the switch
+        :type dpid: int
+
+        :param port_no: out port number
+        :type port_no: int
+
+        :returns: datapath ids of the peers
+        :rtype: set of int
+        """
+        return set(self._ports.get((dpid, port_no), ()))
+
+    def links_of(self, dpid, port_no=None):
+        """
+        Return links incident to a switch, or to one of its ports.
+
+        A link on a port is the one going out of it together with
+        its reverse, as both go down along with the port.
+
+        :param dpid: datapath id of the switch
+        :type dpid: int
+
+        :param port_no: port number to narrow down the lookup
+        :type port_no: int
+
+        :returns: (src, dst) keys of the links
+        :rtype: list of (int, int)
+        """
+        if port_no is None:
+            links = [(dpid, peer) for peer in self._adj.get(dpid, ())]
+            links.extend((peer, dpid) for peer in self._peers_in.get(dpid, ()))
+            return links
+        links = []
+        for peer in self._ports.get((dpid, port_no), ()):
+            links.append((dpid, peer))
+            if dpid in self._adj.get(peer, ()):
+                links.append((peer, dpid))
+        return links
+
+    def footprint(self):
+        """
+        Return memory taken by shortest path trees.
+
+        :returns: size in bytes of tree rows and interned next hops
+        :rtype: int
+        """
+        size = sys.getsizeof(self._trees) + sys.getsizeof(self._index) + \
+            sys.getsizeof(self._dpids) + sys.getsizeof(self._hop_sets) + \
+            sys.getsizeof(self._hop_ids)
+        for rows in self._trees.values():
+            size += sum(sys.getsizeof(row) for row in rows)
+        for hops in self._hop_sets:
+            size += sys.getsizeof(hops)
+        return size
+
+    def _cost(self, root, dpid):
+        """
+        Return path cost from `root` to `dpid` or None if unreachable.
+        """
+        i = self._index.get(dpid)
+        row = self._trees[root][0]
+        if i is None or i >= len(row) or row[i] < 0:
+            return None
+        return row[i]
+
+    def _hops(self, root, dpid):
+        """
+        Return equal cost next hops of `root` towards `dpid`.
+        """
+        i = self._index.get(dpid)
+        row = self._trees[root][2]
+        if i is None or i >= len(row):
+            return ()
+        return self._hop_sets[row[i]]
+
+    def _path(self, src, dst):
+        """
+        Walk the tree of `src` back from `dst`.
+
+        :returns: path to dst from src or None if unreachable
+        :rtype: list of int
+        """
+        if src not in self._trees or self._cost(src, dst) is None:
+            return None
+        parent = self._trees[src][1]
+        dpids = self._dpids
+        i = self._index[dst]
+        path = []
+        while i >= 0:
+            path.append(dpids[i])
+            i = parent[i]
+        path.reverse()
+        return path
+
+    def _compact(self, tree):
+        """
+        Pack a tree as produced by `shortest_path_tree` into rows.
+        """
+        dist, parent, hops = tree
+        index, dpids = self._index, self._dpids
+        for dpid in dist:
+            if dpid not in index:
+                index[dpid] = len(dpids)
+                dpids.append(dpid)
+
+        n = len(dpids)
+        cost_row = array('q', [-1]) * n
+        parent_row = array('i', [-1]) * n
+        hops_row = array('i', [0]) * n
+        for dpid, cost in dist.items():
+            i = index[dpid]
+            cost_row[i] = cost
+            if parent[dpid] is not None:
+                parent_row[i] = index[parent[dpid]]
+            hops_row[i] = self._intern(hops[dpid])
+        return cost_row, parent_row, hops_row
+
+    def _intern(self, hops):
+        key = frozenset(hops)
+        hop_id = self._hop_ids.get(key)
+        if hop_id is None:
+            hop_id = self._hop_ids[key] = len(self._hop_sets)
+            self._hop_sets.append(tuple(sorted(key)))
+        return hop_id
+
+    def _forget(self, root):
+        self._trees.pop(root, None)
+        self._stale.discard(root)
+
+    def _grow(self, root):
+        self._trees[root] = self._compact(self.spf_tree(root))
+
+    def _using(self, src, dst):
+        """
+        Return roots that have the given link on any of their
+        equal cost paths.
+        """
+        cost = self.costs[src][dst]
+        roots = []
+        for root in self._trees:
+            to_src = self._cost(root, src)
+            if to_src is not None and to_src + cost == self._cost(root, dst):
+                roots.append(root)
+        return roots
+
+    def _crossing(self, src, dst):
+        """
+        Return (root, dpid) pairs whose path or next hops go over
+        the given link.
+        """
+        pairs = set()
+        for root in self._using(src, dst):
+            for dpid in self.switches:
+                path = self._path(root, dpid)
+                if path is not None and dst in path and \
+                        path[path.index(dst) - 1] == src:
+                    pairs.add((root, dpid))
+        if src in self._trees:
+            for dpid in self.switches:
+                if dst in self._hops(src, dpid):
+                    pairs.add((src, dpid))
+        return pairs
+
+    def _moved(self, src, dst):
+        """
+        Report pairs affected by an out port change of the given link,
+        once trees are up to date.
+
+        Removed links are remembered as well while rerouting is deferred,
+        as they may come back on another port before `flush`.
+        """
+        if self.deferred:
+            self._relinked.add((src, dst))
+            return set()
+        return self._crossing(src, dst)
+
+    def _alternates(self, src):
+        """
+        Report pairs of a switch whose links have changed, as any of them
+        may have a different backup next hop now, once trees are up to
+        date.
+        """
+        if self.deferred:
+            self._rewired.add(src)
+            return set()
+        return set((src, dpid) for dpid in self.switches if dpid != src)
+
+    def _reroute(self, roots, bulk=False):
+        """
+        Rebuild trees of the given switches, or mark them as stale
+        if rerouting is deferred.
+
+        :param bulk: compute all trees at once with `solver`
+        :type bulk: bool
+
+        :returns: pairs whose path or next hops have changed
+        :rtype: set of (int, int)
+        """
+        if self.deferred:
+            self._stale.update(roots)
+            return set()
+        trees = self.solver(self.costs, list(roots)) if bulk else None
+        return self._rebuild(roots, trees)
+
+    def _rebuild(self, roots, trees=None):
+        """
+        Rebuild trees of the given switches, taking precomputed ones
+        from `trees` where available.
+
+        Peers of a root use its path costs to pick their backup next
+        hops, so their pairs towards switches the root now reaches at
+        a different cost are reported as well. These are collected per
+        peer first, as most of them repeat when many roots are rebuilt.
+
+        :returns: pairs whose path or next hops have changed
+        :rtype: set of (int, int)
+        """
+        changed = set()
+        everything = set()  # peers with all of their pairs reported
+        towards = defaultdict(set)  # peer => dpids to report pairs for
+        for root in roots:
+            old = self._trees.get(root)
+            if trees and root in trees:
+                new = self._compact(trees[root])
+            else:
+                new = self._compact(self.spf_tree(root))
+            self._trees[root] = new
+            changed.update((root, dpid)
+                           for dpid in self._diverged(root, old, new))
+
+            recosted = self._recosted(old, new)
+            changed.update((root, dpid) for dpid in recosted
+                           if dpid != root and dpid in self.switches)
+            if not recosted:
+                continue
+            for peer in self._peers_in.get(root, ()):
+                if peer in recosted:
+                    everything.add(peer)
+                elif peer not in everything:
+                    towards[peer] |= recosted
+
+        for peer in everything & self.switches:
+            changed.update((peer, dpid) for dpid in self.switches
+                           if dpid != peer)
+        for peer, dsts in towards.items():
+            if peer in self.switches and peer not in everything:
+                changed.update((peer, dpid) for dpid in dsts & self.switches
+                               if dpid != peer)
+        return changed
+
+    def _recosted(self, old, new):
+        """
+        Return dpids whose path cost differs between two versions
+        of a tree.
+        """
+        new_row = new[0]
+        if old and old[0] == new_row:
+            return set()
+        old_row = old[0] if old else array('q')
+        recosted = set()
+        for i, dpid in enumerate(self._dpids):
+            old_cost = old_row[i] if i < len(old_row) else -1
+            new_cost = new_row[i] if i < len(new_row) else -1
+            if old_cost != new_cost:
+                recosted.add(dpid)
+        return recosted
+
+    def _diverged(self, root, old, new):
+        """
+        Return switches whose path or next hops from `root` differ
+        between two versions of its tree.
+
+        A path is unchanged if the previous hop is the same and
+        the path to the previous hop is unchanged.
+        """
+        new_parent, new_hops = new[1], new[2]
+        if old is None:
+            index = self._index
+            return [dpid for dpid in self.switches if dpid != root and
+                    index.get(dpid, len(new_parent)) < len(new_parent) and
+                    (new_parent[index[dpid]] >= 0 or new_hops[index[dpid]])]
+        if old[1] == new_parent and old[2] == new_hops:
+            return []
+        old_parent, old_hops = old[1], old[2]
+        moved = {}  # position => path has changed
+
+        def hop(row, i, default):
+            return row[i] if i < len(row) else default
+
+        diverged = []
+        for dpid in self.switches:
+            if dpid == root:
+                continue
+            i = first = self._index.get(dpid)
+            if i is None:
+                continue
+            chain = []
+            while i >= 0 and i not in moved:
+                prev = hop(new_parent, i, -1)
+                if hop(old_parent, i, -1) != prev:
+                    moved[i] = True
+                    break
+                chain.append(i)
+                i = prev
+            result = moved.get(i, False) if i >= 0 else False
+            for j in chain:
+                moved[j] = result
+            if moved[first] or hop(old_hops, first, 0) != \
+                    hop(new_hops, first, 0):
+                diverged.append(dpid)
+        return diverged
+
+
+class HostTable(dict):
+
+    """
+    MAC => (dpid, port_no) table indexed by switch and by port.
+
+    Missing MACs read as None without being stored.
+    """
+
+    def __init__(self):
+        super(HostTable, self).__init__()
+        self.by_dpid = defaultdict(set)  #: dpid => {MAC, ...}
+        self.by_port = defaultdict(set)  #: (dpid, port_no) => {MAC, ...}
+        self.touched = None  #: MACs changed since `Network.snapshot`
+
+    def __missing__(self, mac):
+        return None
+
+    def __setitem__(self, mac, location):
+        if mac in self:
+            self._unindex(mac, self[mac])
+        super(HostTable, self).__setitem__(mac, location)
+        if self.touched is not None:
+            self.touched.add(mac)
+        if location is not None:
+            self.by_dpid[location[0]].add(mac)
+            self.by_port[location].add(mac)
+
+    def __delitem__(self, mac):
+        location = self[mac]
+        super(HostTable, self).__delitem__(mac)
+        if self.touched is not None:
+            self.touched.add(mac)
+        self._unindex(mac, location)
+
+    def pop(self, mac, *default):
+        if mac not in self:
+            return super(HostTable, self).pop(mac, *default)
+        location = self[mac]
+        del self[mac]
+        return location
+
+    def _unindex(self, mac, location):
+        if location is None:
+            return
+        for index, key in ((self.by_dpid, location[0]),
+                           (self.by_port, location)):
+            macs = index.get(key)
+            if macs is not None:
+                macs.discard(mac)
+                if not macs:
+                    del index[key]
+
+
+class AddressTable(dict):
+
+    """
+    IP => MAC table indexed by MAC.
+
+    Missing IPs read as None without being stored. Every change of
+    the MAC an IP maps to is passed to `watchers` as (IP, MAC), with
+    None for a removed IP.
+    """
+
+    def __init__(self):
+        super(AddressTable, self).__init__()
+        self.by_mac = defaultdict(set)  #: MAC => {IP, ...}
+        self.touched = None  #: IPs changed since `Network.snapshot`
+        self.watchers = []  #: Called with (IP, MAC) on every change
+
+    def __missing__(self, ip):
+        return None
+
+    def __setitem__(self, ip, mac):
+        old = self[ip]
+        if ip in self:
+            self._unindex(ip, old)
+        super(AddressTable, self).__setitem__(ip, mac)
+        if self.touched is not None:
+            self.touched.add(ip)
+        if mac is not None:
+            self.by_mac[mac].add(ip)
+        if mac != old:
+            for watcher in self.watchers:
+                watcher(ip, mac)
+
+    def __delitem__(self, ip):
+        mac = self[ip]
+        super(AddressTable, self).__delitem__(ip)
+        if self.touched is not None:
+            self.touched.add(ip)
+        self._unindex(ip, mac)
+        if mac is not None:
+            for watcher in self.watchers:
+                watcher(ip, None)
+
+    def pop(self, ip, *default):
+        if ip not in self:
+            return super(AddressTable, self).pop(ip, *default)
+        mac = self[ip]
+        del self[ip]
+        return mac
+
+    def _unindex(self, ip, mac):
+        ips = self.by_mac.get(mac)
+        if ips is not None:
+            ips.discard(ip)
+            if not ips:
+                del self.by_mac[mac]
+
+
+class NetworkSnapshot(object):
+
+    """
+    Immutable view of `Network` state as of one point in time.
+
+    Tables are `fabric.cow.FrozenMap` shared with other snapshots.
+    Trees are shared with the live `TopologyGraph` as well: they are
+    replaced rather than modified on rebuild, and row positions of
+    dpids never change once assigned.
+
+    While rerouting is deferred, trees of some roots may lag behind
+    `links` until the next flush. Such roots are listed in `stale`
+    and have no paths in the snapshot.
+    """
+
+    def __init__(self, version, switches, links, costs, mac_to_port,
+                 ip_to_mac, topo):
+        self.version = version  #: Bumped on every snapshot that differs
+        self.switches = switches  #: frozenset of dpids
+        self.links = links  #: (src, dst) => out port
+        self.costs = costs  #: (src, dst) => link cost
+        self.mac_to_port = mac_to_port  #: MAC => (dpid, port_no)
+        self.ip_to_mac = ip_to_mac  #: IP => MAC
+        self.stale = frozenset(topo._stale)  #: Roots with outdated trees
+        self._trees = dict((root, tree) for root, tree in topo._trees.items()
+                           if root not in self.stale)
+        self._index = topo._index
+        self._dpids = topo._dpids
+        self._hop_sets = topo._hop_sets
+
+    def path(self, src, dst):
+        """
+        Return path between two switches.
+
+        :returns: path to dst from src or None if unreachable,
+                  or if the tree of `src` is stale
+        :rtype: list of int
+        """
+        tree = self._trees.get(src)
+        i = self._index.get(dst)
+        if tree is None or i is None or i >= len(tree[0]) or tree[0][i] < 0:
+            return None
+        parent = tree[1]
+        path = []
+        while i >= 0:
+            path.append(self._dpids[i])
+            i = parent[i]
+        path.reverse()
+        return path
+
+    def next_hops(self, src, dst):
+        """
+        Return out ports of equal cost next hops between two switches.
+
+        :returns: sorted out ports of `src`, empty if `dst` is unreachable
+                  or the tree of `src` is stale
+        :rtype: tuple of int
+        """
+        tree = self._trees.get(src)
+        i = self._index.get(dst)
+        if tree is None or i is None or i >= len(tree[2]):
+            return ()
+        return tuple(sorted(self.links[src, peer]
+                            for peer in self._hop_sets[tree[2][i]]))
+
+
+class PathTable(Mapping):
+
+    """
+    Read-only (src, dst) => [dpid, ...] view of a `TopologyGraph`.
+
+    Paths are walked back from shortest path trees on access,
+    None is returned for unreachable pairs.
+    """
+
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, pair):
+        return self._graph._path(*pair)
+
+    def __contains__(self, pair):
+        src, dst = pair
+        switches = self._graph.switches
+        return src != dst and src in switches and dst in switches
+
+    def __iter__(self):
+        switches = list(self._graph.switches)
+        for src in switches:
+            for dst in switches:
+                if src != dst:
+                    yield src, dst
+
+    def __len__(self):
+        n = len(self._graph.switches)
+        return n * (n - 1)
+
+
+def shortest_path_tree(costs, src):
+    """
+    Compute the shortest path tree rooted at a given switch.
+
+    Dijkstra over link `costs`, with a `PQDict` as the frontier: a better
+    route to a queued switch decreases its key in place, so the queue
+    never holds more than one entry per switch.
+
+    Equal cost predecessors are only collected during the search.
+    The previous hop of a switch is the lowest of them, so that trees
+    don't depend on the order of the search, see `uniform_trees`.
+    Next hops are merged from them afterwards, in order of distance,
+    and shared rather than copied where they agree.
+
+    :param costs: link costs
+    :type costs: {dpid: {dpid: int}}
+
+    :param src: dpid of the root switch
+    :type src: int
+
+    :returns: path cost, previous hop and equal cost next hops
+              of `src` for every reachable dpid
+    :rtype: ({dpid: int}, {dpid: dpid}, {dpid: frozenset of dpid})
+    """
+    dist = {src: 0}
+    preds = {src: []}
+    order = []
+    done = set()
+    queue = PQDict({src: 0})
+    while queue:
+        a, cost = queue.popitem()
+        done.add(a)
+        order.append(a)
+        for b, link_cost in costs.get(a, {}).items():
+            new_cost = cost + link_cost
+            old_cost = dist.get(b)
+            if old_cost is None:
+                queue.additem(b, new_cost)
+            elif new_cost < old_cost:
+                queue.updateitem(b, new_cost)
+            else:
+                if new_cost == old_cost and b not in done:
+                    preds[b].append(a)
+                continue
+            dist[b] = new_cost
+            preds[b] = [a]
+
+    parent = {src: None}
+    hops = {src: frozenset()}
+    for b in order[1:]:
+        parent[b] = min(preds[b])
+        hops[b] = _merge(src, b, preds[b], hops)
+    return dist, parent, hops
+
+
+def _merge(src, dpid, preds, hops):
+    """
+    Merge next hops of equal cost predecessors of a switch.
+    """
+    if src in preds:
+        merged = frozenset((dpid,))
+        if len(preds) == 1:
+            return merged
+    else:
+        merged = hops[preds[0]]
+    for a in preds:
+        if a != src and hops[a] is not merged:
+            merged = merged | hops[a]
+    return merged
+
+
+def uniform_trees(costs, roots, cost):
+    """
+    Compute shortest path trees of links that all cost the same.
+
+    Breadth-first, a level of the search at a time. Neighbours of
+    a level and predecessors of a switch within it are found with set
+    operations rather than link by link. Switches with the same
+    predecessors share one set of next hops across all trees, as do
+    most leaves of a leaf-spine. Trees are the same as built by
+    `shortest_path_tree`.
+
+    :param costs: link costs, all of them `cost`
+    :type costs: {dpid: {dpid: int}}
+
+    :param roots: dpids of the root switches
+    :type roots: list of int
+
+    :param cost: cost of every link
+    :type cost: int
+
+    :returns: tree for every root
+    :rtype: {dpid: tree}
+    """
+    peers_in = defaultdict(set)
+    for a, peers in costs.items():
+        for b in peers:
+            peers_in[b].add(a)
+    # intersections of frozensets are frozensets, ready to be next hops
+    peers_in = dict((b, frozenset(peers)) for b, peers in peers_in.items())
+
+    trees = {}
+    shared = {}  # next hops => (one copy of them, previous hop)
+    for src in roots:
+        dist = {src: 0}
+        parent = {src: None}
+        hops = {src: frozenset()}
+        level, distance = set((src,)), 0
+        while level:
+            reached = set()
+            for a in level:
+                reached.update(costs.get(a, ()))
+            reached.difference_update(dist)
+            distance += cost
+            dist.update(dict.fromkeys(reached, distance))
+            if distance == cost:
+                for b in reached:
+                    parent[b] = src
+                    hops[b] = frozenset((b,))
+            elif distance == 2 * cost:
+                for b in reached:
+                    preds = peers_in[b] & level
+                    entry = shared.get(preds)
+                    if entry is None:
+                        entry = shared[preds] = (preds, min(preds))
+                    hops[b], parent[b] = entry
+            else:
+                for b in reached:
+                    preds = peers_in[b] & level
+                    parent[b] = min(preds)
+                    hops[b] = _merge(src, b, list(preds), hops)
+            level = reached
+        trees[src] = (dist, parent, hops)
+    return trees
+
+
+def spf_trees(costs, roots):
+    """
+    Compute shortest path trees for a number of roots at once.
+
+    Takes only plain data, so it can run in a worker process
+    on a `TopologyGraph.snapshot`. Links that all cost the same
+    go through `uniform_trees`.
+
+    :param costs: link costs
+    :type costs: {dpid: {dpid: int}}
+
+    :param roots: dpids of the root switches
+    :type roots: list of int
+
+    :returns: tree for every root
+    :rtype: {dpid: tree}
+    """
+    link_costs = set()
+    for peers in costs.values():
+        link_costs.update(peers.values())
+        if len(link_costs) > 1:
+            break
+    if len(link_costs) == 1:
+        cost, = link_costs
+        if cost > 0:
+            return uniform_trees(costs, roots, cost)
+    return dict((root, shortest_path_tree(costs, root)) for root in roots)
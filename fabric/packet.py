@@ -1,20 +1,83 @@
 """
-This module contains pure functions to parse and craft packets.
+This module contains pure functions to parse and craft packets,
+and caches of crafted ones.
 """
+import binascii
+from collections import OrderedDict
+import socket
+import struct
 
 from ryu.ofproto import ofproto_v1_4 as ofp
-from ryu.lib.packet import packet
-from ryu.lib.packet import ethernet
+from ryu.lib import addrconv
 from ryu.lib.packet import arp
 from ryu.lib.packet import lldp
 from ryu.ofproto import ether as ethertypes
-import fabric.flows as flows
+
+
+PORT_ID_WIDTH = 8  #: Hex digits of port id in LLDP, enough for any port_no
+_lldp_templates = {}  # dpid => (LLDP frame, offset of port id)
+
+ETH_HEADER = struct.Struct("!6s6sH")  #: dst, src, ethertype
+ETH_TYPE = struct.Struct("!12xH")  #: ethertype only
+ETH_SRC = struct.Struct("!6x6s")  #: source MAC only
+ARP_HEADER = struct.Struct("!6xH6x4s6x4s")  #: opcode, spa, tpa
+ARP_FRAME = struct.Struct("!6s6sHHHBBH6s4s6s4s")  #: Ethernet and ARP
+ETH_MIN_LEN = 60  #: Shorter frames are padded, FCS not included
+LLDP_TLV_HEADER = struct.Struct("!H")  #: 7 bits type, 9 bits length
+_MAC = struct.Struct("!6B")
+_MAC_FORMAT = ":".join(["%02x"] * 6)
+
+
+def _tlv(tlv_type, value):
+    """
+    Encode an LLDP TLV: 7 bits of type, 9 bits of length, value.
+    """
+    return struct.pack("!H", tlv_type << 9 | len(value)) + value
+
+
+def lldp_template(dpid):
+    '''
+    Return a prebuilt LLDP frame of a switch, built on first use.
+
+    Frame is what Ryu would serialize for `create_lldp`, with the port
+    id zero-padded to `PORT_ID_WIDTH` hex digits so that every port fits
+    in the same place.
+
+    :param dpid: 64bit switch id
+    :type dpid: int
+
+    :returns: frame and offset of port id digits in it
+    :rtype: (bytes, int)
+    '''
+    template = _lldp_templates.get(dpid)
+    if template is not None:
+        return template
+
+    dst = addrconv.mac.text_to_bin(lldp.LLDP_MAC_NEAREST_BRIDGE)
+    src = struct.pack("!Q", dpid & (2 ** 48 - 1))[2:]
+    eth = dst + src + struct.pack("!H", ethertypes.ETH_TYPE_LLDP)
+    chassis = _tlv(lldp.LLDP_TLV_CHASSIS_ID,
+                   struct.pack("!B", lldp.ChassisID.SUB_LOCALLY_ASSIGNED) +
+                   ("0x%x" % dpid).encode("ascii"))
+    port_prefix = struct.pack("!B", lldp.PortID.SUB_INTERFACE_NAME) + b"0x"
+    port = _tlv(lldp.LLDP_TLV_PORT_ID,
+                port_prefix + b"0" * PORT_ID_WIDTH)
+    ttl = _tlv(lldp.LLDP_TLV_TTL, struct.pack("!H", 1))
+    end = _tlv(lldp.LLDP_TLV_END, b"")
+
+    frame = eth + chassis + port + ttl + end
+    frame += b"\0" * max(0, 60 - len(frame))  # minimal Ethernet frame
+    offset = len(eth + chassis) + 2 + len(port_prefix)
+    template = _lldp_templates[dpid] = (frame, offset)
+    return template
 
 
 def create_lldp(dpid, port_no=ofp.OFPP_FLOOD):
     '''
     Create an LLDP broadcast packet.
 
+    Copies the frame template of the switch and patches the port id in.
+
     :param dpid: 64bit switch id
     :type dpid: int
 
@@ -24,23 +87,11 @@ def create_lldp(dpid, port_no=ofp.OFPP_FLOOD):
     :returns: binary representation of LLDP packet
     :rtype: `bytearray`
     '''
-
-    pkt = packet.Packet()  # creating empty pkt
-    dst = lldp.LLDP_MAC_NEAREST_BRIDGE  # Singlehop LLDP multicast
-    src = flows.int_to_mac(dpid)
-    ethertype = ethertypes.ETH_TYPE_LLDP
-    eth_pkt = ethernet.ethernet(dst, src, ethertype)
-    pkt.add_protocol(eth_pkt)  # Adding Ethernet
-    tlvs = (lldp.ChassisID(subtype=lldp.ChassisID.SUB_LOCALLY_ASSIGNED,
-                           chassis_id=hex(dpid)),
-            lldp.PortID(subtype=lldp.PortID.SUB_INTERFACE_NAME,
-                        port_id=hex(port_no)),
-            lldp.TTL(ttl=1),
-            lldp.End())
-    lldp_pkt = lldp.lldp(tlvs)
-    pkt.add_protocol(lldp_pkt)  # Adding llDP
-    pkt.serialize()
-    return pkt.data
+    frame, offset = lldp_template(dpid)
+    pkt = bytearray(frame)
+    pkt[offset:offset + PORT_ID_WIDTH] = \
+        ("%0*x" % (PORT_ID_WIDTH, port_no)).encode("ascii")
+    return pkt
 
 
 def create_arp(dl_src, dl_dst, nl_src, nl_dst):
@@ -62,56 +113,213 @@ def create_arp(dl_src, dl_dst, nl_src, nl_dst):
     :returns: binary representation of ARP packet
     :rtype: `bytearray`
     '''
-    pkt = packet.Packet()
-    pkt.add_protocol(ethernet.ethernet(ethertype=ethertypes.ETH_TYPE_ARP,
-                                       dst=dl_dst,
-                                       src=dl_src))
-    pkt.add_protocol(arp.arp(opcode=arp.ARP_REPLY,
-                             src_mac=dl_src,
-                             src_ip=nl_src,
-                             dst_mac=dl_dst,
-                             dst_ip=nl_dst))
-    return pkt.serialize()
+    frame = ARP_FRAME.pack(_mac_to_bin(dl_dst), _mac_to_bin(dl_src),
+                           ethertypes.ETH_TYPE_ARP,
+                           1, ethertypes.ETH_TYPE_IP, 6, 4, arp.ARP_REPLY,
+                           _mac_to_bin(dl_src), socket.inet_aton(nl_src),
+                           _mac_to_bin(dl_dst), socket.inet_aton(nl_dst))
+    return bytearray(frame + b"\0" * (ETH_MIN_LEN - len(frame)))
+
+
+class ArpReplyCache(object):
+
+    """
+    LRU cache of ready to send ARP replies.
+
+    Replies are keyed by target IP and requester MAC and IP. Every entry
+    remembers the MAC it was built for and is rebuilt on lookup once
+    `Network.ip_to_mac` maps the target elsewhere, so entries never
+    outlive a change of the table.
+    """
+
+    def __init__(self, size=4096):
+        """
+        :param size: maximum number of replies kept
+        :type size: int
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._replies = OrderedDict()  # (IP, MAC, IP) => (MAC, frame)
+
+    def reply(self, ip_to_mac, nl_dst, dl_src, nl_src):
+        '''
+        Return ARP reply to a request, building it on a miss.
+
+        :param ip_to_mac: IP => MAC table to resolve the target with
+        :type ip_to_mac: `fabric.network.AddressTable`
+
+        :param nl_dst: target IP of the request
+        :type nl_dst: str
+
+        :param dl_src: MAC address of the requester
+        :type dl_src: str
+
+        :param nl_src: IP address of the requester
+        :type nl_src: str
+
+        :returns: reply frame or None if the target is unknown
+        :rtype: bytes
+        '''
+        dl_dst = ip_to_mac.get(nl_dst)
+        if dl_dst is None:
+            return None
+        key = (nl_dst, dl_src, nl_src)
+        entry = self._replies.pop(key, None)
+        if entry is not None and entry[0] == dl_dst:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = (dl_dst, bytes(create_arp(dl_dst, dl_src, nl_dst, nl_src)))
+            if len(self._replies) >= self.size:
+                self._replies.popitem(last=False)
+        self._replies[key] = entry
+        return entry[1]
+
+    def __len__(self):
+        return len(self._replies)
+
+
+def ethertype(data):
+    '''
+    Read ethertype of a frame without parsing anything else.
+
+    :param data: binary of a packet
+    :type data: `bytearray`
+
+    :returns: ethertype, or None if the frame is too short
+    :rtype: int
+    '''
+    if len(data) < ETH_TYPE.size:
+        return None
+    return ETH_TYPE.unpack_from(data)[0]
 
 
-def parse_lldp(data):
+def eth_src(data):
     '''
-    Parse LLDP headers and adds them to provided dict.
+    Read source MAC of a frame without parsing anything else.
 
-    :param data: binary of a packet to parse
+    :param data: binary of a packet
     :type data: `bytearray`
 
-    :returns: `headers` with additional entries of "peer_id"
-              and "peer_port" form LLDP
-    :rtype: dict
+    :returns: MAC address
+    :rtype: str
     '''
+    return _mac(ETH_SRC.unpack_from(data)[0])
 
-    pkt = packet.Packet(data)
-    pkt_lldp = pkt.get_protocol(lldp.lldp)
 
-    headers = {"peer_id": int(pkt_lldp.tlvs[0].chassis_id, 16),
-               "peer_port": int(pkt_lldp.tlvs[1].port_id, 16)}
+def eth_srcs(frames):
+    '''
+    Read source MACs of a batch of frames.
+
+    Every distinct MAC is formatted once, however many frames of the
+    batch it sent.
+
+    :param frames: binaries of packets
+    :type frames: list of `bytearray`
+
+    :returns: MAC addresses, in order of frames
+    :rtype: list of str
+    '''
+    seen = {}
+    macs = []
+    for data in frames:
+        raw = ETH_SRC.unpack_from(data)[0]
+        mac = seen.get(raw)
+        if mac is None:
+            mac = seen[raw] = _mac(raw)
+        macs.append(mac)
+    return macs
+
 
+def _mac_to_bin(mac):
+    """
+    Pack a MAC address into 6 bytes.
+    """
+    return binascii.unhexlify(mac.replace(":", ""))
+
+
+def _mac(buf):
+    """
+    Format 6 bytes as a MAC address the way Ryu does.
+    """
+    return _MAC_FORMAT % _MAC.unpack(buf)
+
+
+def parse_lldp(data, offset=ETH_HEADER.size):
+    '''
+    Parse LLDP headers and adds them to provided dict.
+
+    Only chassis and port TLVs are read, straight from the frame.
+    Frames whose TLVs don't look like the ones `create_lldp` writes,
+    e.g. from a host running an LLDP daemon, are not parsed.
+
+    :param data: binary of a packet to parse
+    :type data: `bytearray` or `memoryview`
+
+    :param offset: where LLDP starts in `data`
+    :type offset: int
+
+    :returns: `headers` with entries of "peer_id" and "peer_port"
+              from LLDP, or no entries if the frame is not ours
+    :rtype: dict
+    '''
+    view = memoryview(data)
+    headers = {}
+    while offset + LLDP_TLV_HEADER.size <= len(view):
+        tlv_header, = LLDP_TLV_HEADER.unpack_from(view, offset)
+        tlv_type, length = tlv_header >> 9, tlv_header & 0x1ff
+        offset += LLDP_TLV_HEADER.size
+        if tlv_type == lldp.LLDP_TLV_END or offset + length > len(view):
+            break
+        if tlv_type == lldp.LLDP_TLV_CHASSIS_ID:
+            headers["peer_id"] = _hex_value(
+                view, offset, length, lldp.ChassisID.SUB_LOCALLY_ASSIGNED)
+        elif tlv_type == lldp.LLDP_TLV_PORT_ID:
+            headers["peer_port"] = _hex_value(
+                view, offset, length, lldp.PortID.SUB_INTERFACE_NAME)
+            break
+        offset += length
+    if headers.get("peer_id") is None or headers.get("peer_port") is None:
+        return {}
     return headers
 
 
-def parse_arp(data):
+def _hex_value(view, offset, length, subtype):
+    """
+    Read a TLV value of a subtype written as a "0x" prefixed hex number,
+    or return None if it is anything else.
+    """
+    # value starts with a subtype byte
+    if length < 4 or view[offset] != subtype:
+        return None
+    value = bytes(view[offset + 1:offset + length])
+    if not value.startswith(b"0x"):
+        return None
+    try:
+        return int(value[2:], 16)
+    except ValueError:
+        return None
+
+
+def parse_arp(data, offset=ETH_HEADER.size):
     '''
     Parse ARP headers and add them to provided dict.
 
     :param data: binary of a packet to parse
-    :type data: `bytearray`
+    :type data: `bytearray` or `memoryview`
+
+    :param offset: where ARP starts in `data`
+    :type offset: int
 
     :returns: `headers` with entries of "opcode", "nl_src" and "nl_dst"
               from ARP.
     :rtype: dict
     '''
-    pkt = packet.Packet(data)
-    pkt_arp = pkt.get_protocol(arp.arp)
-
-    headers = {"nl_src": pkt_arp.src_ip,
-               "nl_dst": pkt_arp.dst_ip,
-               "opcode": pkt_arp.opcode}
+    opcode, nl_src, nl_dst = ARP_HEADER.unpack_from(data, offset)
+    headers = {"nl_src": socket.inet_ntoa(nl_src),
+               "nl_dst": socket.inet_ntoa(nl_dst),
+               "opcode": opcode}
 
     return headers
 
@@ -121,6 +329,9 @@ def parse(data):
     Parse Ethernet headers and calls for additional parsing
     in case of ARP and LLDP.
 
+    Headers are unpacked with precompiled `struct` formats from
+    a `memoryview` of the frame, without building Ryu packet objects.
+
     :param data: binary of a packet to parse
     :type data: `bytearray`
 
@@ -128,16 +339,16 @@ def parse(data):
               with "dl_src" and "dl_dst" and "ethertype" at minimum;
     :rtype: dict
     '''
-    pkt = packet.Packet(data)
-    pkt_eth = pkt.get_protocol(ethernet.ethernet)
+    view = memoryview(data)
+    dl_dst, dl_src, ethertype = ETH_HEADER.unpack_from(view)
 
-    headers = {"dl_src": pkt_eth.src,
-               "dl_dst": pkt_eth.dst,
-               "ethertype": pkt_eth.ethertype}
+    headers = {"dl_src": _mac(dl_src),
+               "dl_dst": _mac(dl_dst),
+               "ethertype": ethertype}
 
-    if headers["ethertype"] == ethertypes.ETH_TYPE_ARP:
-        headers.update(parse_arp(data))
-    elif headers["ethertype"] == ethertypes.ETH_TYPE_LLDP:
-        headers.update(parse_lldp(data))
+    if ethertype == ethertypes.ETH_TYPE_ARP:
+        headers.update(parse_arp(view))
+    elif ethertype == ethertypes.ETH_TYPE_LLDP:
+        headers.update(parse_lldp(view))
 
     return headers
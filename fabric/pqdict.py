@@ -60,7 +60,10 @@ __version__ = (0, 5, 0)
 __all__ = ['PQDict', 'sort_by_value', 'nlargest', 'nsmallest', 'consume']
 
 import sys
-from collections import Mapping, MutableMapping
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
 if sys.version_info[0] < 3:
     range = xrange
 
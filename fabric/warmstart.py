@@ -0,0 +1,209 @@
+"""
+This module contains warm start snapshots of network state.
+
+Switches, links with their costs, port speeds and configured metrics,
+shortest path trees and host tables of a `fabric.network.Network`
+are written to a compact binary file, a header followed by raw `array`
+sections. The file is memory-mapped on load, so sections are copied
+straight into arrays without parsing.
+
+Everything restored is unconfirmed until seen live again, see
+`fabric.network.Network.validate`.
+"""
+from array import array
+import mmap
+import os
+import struct
+import sys
+
+from fabric.network import Network
+
+
+MAGIC = b"FBWS"
+FORMAT = 2  #: Bumped on every incompatible change of the layout
+HEADER = struct.Struct("<4sHcB")  # magic, format, byte order, int size
+SECTION = struct.Struct("<Q")  # number of items that follow
+
+
+def save(net, path):
+    """
+    Write a snapshot of the network state.
+
+    The file is replaced atomically, a reader never sees it half written.
+
+    :param net: network state to save
+    :type net: `fabric.network.Network`
+
+    :param path: file to write to
+    :type path: str
+    """
+    topo = net.topo
+    links = array('Q')
+    for (src, dst), port_no in topo.items():
+        if port_no is not None:
+            links.extend((src, dst, port_no, topo.costs[src][dst]))
+
+    hop_lengths = array('i', (len(hops) for hops in topo._hop_sets))
+    hop_items = array('Q', (dpid for hops in topo._hop_sets
+                            for dpid in hops))
+
+    roots = array('Q', topo._trees)
+    row_lengths = array('i')
+    cost_rows, parent_rows, hops_rows = array('q'), array('i'), array('i')
+    for root in roots:
+        cost_row, parent_row, hops_row = topo._trees[root]
+        row_lengths.append(len(cost_row))
+        cost_rows.extend(cost_row)
+        parent_rows.extend(parent_row)
+        hops_rows.extend(hops_row)
+
+    macs = list(net.mac_to_port)
+    locations = array('Q', (n for mac in macs
+                            for n in net.mac_to_port[mac]))
+    ips = list(net.ip_to_mac)
+
+    sections = [
+        array('Q', topo.switches), links, array('Q', topo._dpids),
+        hop_lengths, hop_items,
+        roots, row_lengths, cost_rows, parent_rows, hops_rows,
+        _pack(macs), locations,
+        _pack(ips), _pack(net.ip_to_mac[ip] for ip in ips),
+        _flatten(net.port_speed), _flatten(net.metrics),
+    ]
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT, sys.byteorder[0].encode(),
+                            array('i').itemsize))
+        for section in sections:
+            f.write(SECTION.pack(len(section)))
+            section.tofile(f)
+    os.rename(tmp, path)
+
+
+def load(path, **kwargs):
+    """
+    Restore network state from a snapshot.
+
+    :param path: file written by `save`
+    :type path: str
+
+    :param kwargs: passed on to `fabric.network.Network`
+
+    :returns: restored network with everything marked as unconfirmed
+    :rtype: `fabric.network.Network`
+
+    :raises ValueError: if the file was written in another format,
+                        or on a platform with other byte order
+    """
+    with open(path, "rb") as f:
+        with _mapped(f) as buf:
+            view = memoryview(buf)
+            try:
+                sections = _unpack(view)
+            finally:
+                view.release()
+
+    (switches, links, dpids, hop_lengths, hop_items, roots, row_lengths,
+     cost_rows, parent_rows, hops_rows, macs, locations, ips,
+     ip_macs, speeds, metrics) = sections
+
+    net = Network(**kwargs)
+    topo = net.topo
+    for i in range(0, len(speeds), 3):
+        net.port_speed[speeds[i], speeds[i + 1]] = speeds[i + 2]
+    for i in range(0, len(metrics), 3):
+        net.metrics[metrics[i], metrics[i + 1]] = metrics[i + 2]
+    for dpid in switches:
+        topo.switches.add(dpid)
+        net.unconfirmed.add(dpid)
+    for i in range(0, len(links), 4):
+        src, dst, port_no, cost = links[i:i + 4]
+        topo[src, dst] = port_no
+        topo.costs[src][dst] = cost
+        net.unconfirmed.add((src, dst))
+
+    topo._dpids = dpids.tolist()
+    topo._index = dict((dpid, i) for i, dpid in enumerate(topo._dpids))
+    topo._hop_sets = []
+    start = 0
+    for length in hop_lengths:
+        topo._hop_sets.append(tuple(hop_items[start:start + length]))
+        start += length
+    topo._hop_ids = dict((frozenset(hops), hop_id)
+                         for hop_id, hops in enumerate(topo._hop_sets))
+
+    start = 0
+    for root, length in zip(roots, row_lengths):
+        end = start + length
+        topo._trees[root] = (cost_rows[start:end], parent_rows[start:end],
+                             hops_rows[start:end])
+        start = end
+
+    for i, mac in enumerate(_split(macs)):
+        net.mac_to_port[mac] = (locations[2 * i], locations[2 * i + 1])
+    for ip, mac in zip(_split(ips), _split(ip_macs)):
+        net.ip_to_mac[ip] = mac
+    return net
+
+
+def _mapped(f):
+    """
+    Map a file read-only, empty files can't be mapped.
+    """
+    size = os.fstat(f.fileno()).st_size
+    if size < HEADER.size:
+        raise ValueError("Truncated warm start snapshot")
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _unpack(view):
+    """
+    Copy sections of a mapped snapshot into arrays.
+    """
+    magic, version, byteorder, int_size = HEADER.unpack_from(view)
+    if magic != MAGIC or version != FORMAT:
+        raise ValueError("Not a warm start snapshot of format %d" % FORMAT)
+    if byteorder != sys.byteorder[0].encode() or \
+            int_size != array('i').itemsize:
+        raise ValueError("Warm start snapshot is from another platform")
+
+    offset = HEADER.size
+    sections = []
+    for typecode in "QQQiQQiqiiBQBBQQ":
+        if offset + SECTION.size > len(view):
+            raise ValueError("Truncated warm start snapshot")
+        count, = SECTION.unpack_from(view, offset)
+        offset += SECTION.size
+        section = array(typecode)
+        end = offset + count * section.itemsize
+        if end > len(view):
+            raise ValueError("Truncated warm start snapshot")
+        section.frombytes(view[offset:end])
+        sections.append(section)
+        offset = end
+    return sections
+
+
+def _flatten(table):
+    """
+    Lay out a (dpid, port_no) => int table as flat triples.
+    """
+    return array('Q', (n for (dpid, port_no), value in table.items()
+                       for n in (dpid, port_no, value)))
+
+
+def _pack(strings):
+    """
+    Join strings into a NUL separated byte array.
+    """
+    return array('B', b"\0".join(s.encode() for s in strings))
+
+
+def _split(blob):
+    """
+    Split a byte array produced by `_pack` back into strings.
+    """
+    if not blob:
+        return []
+    return [s.decode() for s in blob.tobytes().split(b"\0")]
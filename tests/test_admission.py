@@ -0,0 +1,72 @@
+"""
+PacketIns are admitted up to token bucket rates of switches and sources.
+"""
+from fabric.admission import Admission, TokenBucket
+
+
+LLDP, ARP, IPV4 = 0x88cc, 0x0806, 0x0800
+
+
+def test_burst():
+    bucket = TokenBucket(10, 5)
+    assert all(bucket.take(0.0) for _ in range(5))
+    assert not bucket.take(0.0)
+
+
+def test_refill():
+    bucket = TokenBucket(10, 5)
+    for _ in range(5):
+        bucket.take(0.0)
+    assert not bucket.take(0.05)
+    assert bucket.take(0.1)
+    assert not bucket.take(0.1)
+
+
+def test_refill_capped_at_burst():
+    bucket = TokenBucket(10, 5)
+    assert sum(bucket.take(100.0) for _ in range(10)) == 5
+
+
+def test_control_and_data_apart():
+    admission = Admission(burst=2, control_burst=3, source_burst=100,
+                          control=(LLDP, ARP))
+    assert [admission.admit(1, "a", IPV4, 0.0) for _ in range(3)] == \
+        [True, True, False]
+    assert [admission.admit(1, "a", LLDP, 0.0) for _ in range(4)] == \
+        [True, True, True, False]
+    assert admission.admit(2, "a", IPV4, 0.0)
+
+
+def test_source_held_back_before_switch():
+    admission = Admission(burst=10, source_burst=2)
+    assert [admission.admit(1, "a", IPV4, 0.0) for _ in range(3)] == \
+        [True, True, False]
+    assert admission.admit(1, "b", IPV4, 0.0)
+    assert admission.admit(1, "a", IPV4, 0.0, source=False)
+
+
+def test_sources_evicted_least_recently_used():
+    admission = Admission(source_burst=1, sources=2)
+    assert admission.admit(1, "a", IPV4, 0.0)
+    assert admission.admit(1, "b", IPV4, 0.0)
+    assert not admission.admit(1, "a", IPV4, 0.0)
+    assert admission.admit(1, "c", IPV4, 0.0)
+    assert list(admission._sources) == ["a", "c"]
+    assert admission.admit(1, "b", IPV4, 0.0)
+
+
+def test_counters():
+    admission = Admission(burst=2, source_burst=3)
+    for _ in range(3):
+        admission.admit(1, "a", IPV4, 0.0)
+    admission.admit(1, "a", IPV4, 0.0)
+    assert admission.counters == {"admitted": 2, "dropped_switch": 1,
+                                  "dropped_source": 1}
+
+
+def test_forget_switch():
+    admission = Admission(burst=1, source_burst=100)
+    assert admission.admit(1, "a", IPV4, 0.0)
+    assert not admission.admit(1, "a", IPV4, 0.0)
+    admission.forget_switch(1)
+    assert admission.admit(1, "a", IPV4, 0.0)
@@ -0,0 +1,43 @@
+"""
+Versions of a `FrozenMap` stay independent while sharing shards.
+"""
+import pickle
+
+from fabric.cow import DELETED, SHARDS, FrozenMap
+
+
+def test_contents():
+    items = dict((i, str(i)) for i in range(1000))
+    frozen = FrozenMap(items)
+    assert dict(frozen) == items
+    assert len(frozen) == 1000
+    assert frozen[7] == "7"
+    assert 7 in frozen and 1000 not in frozen
+    assert frozen.get(1000, "none") == "none"
+    assert FrozenMap(items.items()) == frozen
+
+
+def test_evolve_leaves_old_version():
+    old = FrozenMap((i, i) for i in range(100))
+    new = old.evolve({1: "one", 100: 100, 2: DELETED, 1000: DELETED})
+    assert dict(old) == dict((i, i) for i in range(100))
+    assert new[1] == "one" and new[100] == 100 and 2 not in new
+    assert len(new) == 100
+    assert old.evolve({}) is old
+
+
+def test_evolve_shares_untouched_shards():
+    old = FrozenMap((i, i) for i in range(10000))
+    new = old.evolve({1: -1, 2: -2})
+    assert new.shared(old) >= SHARDS - 2
+    assert old.shared(old) == SHARDS
+
+
+def test_pickle_round_trip():
+    frozen = FrozenMap({"a": 1, (1, 2): [3], "gone": 4}).evolve(
+        {"gone": DELETED, "b": 2})
+    restored = pickle.loads(pickle.dumps(frozen))
+    assert isinstance(restored, FrozenMap)
+    assert dict(restored) == {"a": 1, (1, 2): [3], "b": 2}
+    assert len(restored) == 3
+    assert restored["a"] == 1
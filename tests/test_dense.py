@@ -0,0 +1,48 @@
+"""
+Trees of the NumPy backend match the ones searched per root.
+"""
+import random
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from fabric import dense, network  # noqa: E402
+
+
+def random_costs(seed, switches=16, density=0.25, weights=(1, 2, 3, 10)):
+    """
+    Produce links with random costs, some switches unreachable.
+    """
+    rnd = random.Random(seed)
+    costs = {}
+    for a in range(switches):
+        for b in range(switches):
+            if a != b and rnd.random() < density:
+                costs.setdefault(a, {})[b] = rnd.choice(weights)
+    return costs
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_trees(seed):
+    costs = random_costs(seed)
+    roots = list(range(16))
+    expected = network.spf_trees(costs, roots)
+    trees = dense.spf_trees(costs, roots)
+    for root in roots:
+        dist, parent, hops = trees[root]
+        assert dist == expected[root][0]
+        assert parent == expected[root][1]
+        assert hops == expected[root][2]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_uniform_trees(seed):
+    costs = random_costs(seed, weights=(1,))
+    roots = list(range(16))
+    assert dense.spf_trees(costs, roots) == network.spf_trees(costs, roots)
+
+
+def test_few_roots_searched_one_by_one():
+    costs = random_costs(0)
+    assert dense.spf_trees(costs, [3]) == network.spf_trees(costs, [3])
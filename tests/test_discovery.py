@@ -0,0 +1,110 @@
+"""
+LLDP probes are paced per port and links expire once probes go unanswered.
+"""
+from fabric.discovery import DiscoveryScheduler
+
+
+FLOOD = 0xfffffffb
+
+
+def test_phases_spread():
+    scheduler = DiscoveryScheduler(interval=10.0)
+    for port_no in range(1, 101):
+        scheduler.add_port(1, port_no, 0.0)
+    deadlines = sorted(scheduler.deadlines.values())
+    assert all(0.0 <= deadline < 10.0 for deadline in deadlines)
+    gaps = [b - a for a, b in zip(deadlines, deadlines[1:])]
+    assert max(gaps) < 3 * 10.0 / 100
+
+
+def test_add_port_twice_keeps_deadline():
+    scheduler = DiscoveryScheduler()
+    scheduler.add_port(1, 1, 0.0)
+    deadline = scheduler.next_deadline()
+    scheduler.add_port(1, 1, 100.0)
+    assert scheduler.next_deadline() == deadline
+
+
+def test_due_once_per_interval():
+    scheduler = DiscoveryScheduler(interval=5.0)
+    scheduler.add_port(1, 1, 0.0)
+    first = scheduler.next_deadline()
+    assert scheduler.due(first - 0.1) == ([], set())
+    assert scheduler.due(first) == ([(1, 1)], set())
+    assert scheduler.next_deadline() == first + 5.0
+    assert scheduler.due(first + 1.0) == ([], set())
+
+
+def test_due_catches_up_without_burst():
+    scheduler = DiscoveryScheduler(interval=5.0)
+    scheduler.add_port(1, 1, 0.0)
+    probes, _ = scheduler.due(100.0)
+    assert probes == [(1, 1)]
+    assert scheduler.next_deadline() == 105.0
+    assert scheduler.due(100.0) == ([], set())
+
+
+def test_expiry_after_misses():
+    scheduler = DiscoveryScheduler(interval=1.0, misses=2)
+    scheduler.add_port(1, 1, 0.0)
+    scheduler.seen(2, 3, 1, 1)
+    now = scheduler.next_deadline()
+    for _ in range(2):
+        assert scheduler.due(now) == ([(1, 1)], set())
+        now += 1.0
+    assert scheduler.due(now) == ([(1, 1)], set([(2, 1)]))
+    assert scheduler.counters["expired"] == 1
+    assert scheduler.due(now + 1.0) == ([(1, 1)], set())
+
+
+def test_seen_resets_misses():
+    scheduler = DiscoveryScheduler(interval=1.0, misses=2)
+    scheduler.add_port(1, 1, 0.0)
+    now = scheduler.next_deadline()
+    for _ in range(10):
+        scheduler.seen(2, 3, 1, 1)
+        assert scheduler.due(now) == ([(1, 1)], set())
+        now += 1.0
+    assert scheduler.missed[1, 1] == 1
+
+
+def test_remove_port_returns_learned_links():
+    scheduler = DiscoveryScheduler()
+    scheduler.add_port(1, 1, 0.0)
+    scheduler.seen(2, 3, 1, 1)
+    assert scheduler.remove_port(1, 1) == set([(2, 1)])
+    assert scheduler.next_deadline() is None
+
+
+def test_request_deduplicated():
+    scheduler = DiscoveryScheduler(holdoff=1.0)
+    assert scheduler.request(1, 1, 0.0)
+    assert not scheduler.request(1, 1, 0.5)
+    assert scheduler.request(1, 2, 0.5)
+    assert scheduler.request(1, 1, 1.0)
+    assert scheduler.counters["requested"] == 4
+    assert scheduler.counters["suppressed"] == 1
+
+
+def test_request_again_once_seen():
+    scheduler = DiscoveryScheduler(holdoff=1.0)
+    assert scheduler.request(1, 1, 0.0)
+    scheduler.seen(2, 3, 1, 1)
+    assert scheduler.request(1, 1, 0.1)
+
+
+def test_flood_covers_ports():
+    scheduler = DiscoveryScheduler(holdoff=1.0, flood=FLOOD)
+    assert scheduler.request(1, FLOOD, 0.0)
+    assert not scheduler.request(1, 1, 0.1)
+    assert scheduler.request(2, 1, 0.1)
+    assert scheduler.request(1, 1, 1.0)
+
+
+def test_outstanding_bound():
+    scheduler = DiscoveryScheduler(holdoff=1.0, outstanding=3)
+    assert all(scheduler.request(1, port_no, 0.0) for port_no in (1, 2, 3))
+    assert not scheduler.request(1, 4, 0.5)
+    scheduler.seen(2, 1, 1, 1)
+    assert scheduler.request(1, 4, 0.5)
+    assert scheduler.request(1, 5, 1.0)
@@ -0,0 +1,204 @@
+"""
+Incremental and deferred rerouting against full recomputes.
+
+The same random series of topology events is fed to networks in every
+rerouting mode. After every event, or every `flush` when deferred,
+next hops reported by `TopologyGraph.diff` must match what a fresh
+`run_spf` computes for all pairs.
+"""
+import random
+
+import pytest
+
+from fabric.network import Network, shortest_path_tree, uniform_trees
+
+
+SWITCHES = 12
+EVENTS = 100
+SPEEDS = (1000000, 10000000, 100000000)
+
+
+def expected(net):
+    """
+    Next hops of all pairs as computed from scratch.
+    """
+    fresh = Network(incremental=False)
+    for dpid in net.topo.switches:
+        fresh.add_switch(dpid)
+    fresh.port_speed.update(net.port_speed)
+    fresh.metrics.update(net.metrics)
+    for (src, dst), port_no in net.topo.items():
+        if port_no is not None:
+            fresh.topo[src, dst] = port_no
+            fresh.topo.costs[src][dst] = net.topo.costs[src][dst]
+    fresh.topo.run_spf()
+    topo = fresh.topo
+    return dict(((src, dst), (topo.next_hops(src, dst),
+                              topo.backup_hop(src, dst)))
+                for src in topo.switches for dst in topo.switches
+                if src != dst and topo.next_hops(src, dst))
+
+
+def reported(net):
+    """
+    Next hops of all pairs as reported by `diff` so far.
+    """
+    return dict(((src, dst), hops) for src, fib in net.topo.fib.items()
+                for dst, hops in fib.items())
+
+
+def events(seed):
+    """
+    Produce a random series of topology events.
+    """
+    rnd = random.Random(seed)
+    for _ in range(EVENTS):
+        kind = rnd.random()
+        src, dst = rnd.sample(range(1, SWITCHES + 1), 2)
+        if kind < 0.5:
+            yield "add_peer", (src, dst, dst)
+            yield "add_peer", (dst, src, src)
+        elif kind < 0.7:
+            yield "remove_peer", (src, dst)
+        elif kind < 0.85:
+            yield "set_port_speed", (src, dst, rnd.choice(SPEEDS))
+        elif kind < 0.95:
+            yield "set_metric", (src, dst, rnd.choice((None, 1, 5)))
+        else:
+            yield "purge", (src,)
+            yield "add_switch", (src,)
+
+
+def replay(net, seed, every=1):
+    """
+    Apply random events to a network, checking its reported next hops
+    after every `every` of them.
+    """
+    for dpid in range(1, SWITCHES + 1):
+        net.topo.diff(net.add_switch(dpid))
+    for i, (name, args) in enumerate(events(seed)):
+        net.topo.diff(getattr(net, name)(*args))
+        if (i + 1) % every:
+            continue
+        if net.topo.deferred:
+            net.topo.diff(net.flush())
+        assert reported(net) == expected(net), (i, name, args)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_incremental(seed):
+    replay(Network(), seed)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_full(seed):
+    replay(Network(incremental=False), seed)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_deferred(seed):
+    replay(Network(deferred=True), seed, every=7)
+
+
+def test_deferred_snapshot_trees():
+    net = Network(deferred=True)
+    for dpid in range(1, SWITCHES + 1):
+        net.add_switch(dpid)
+    for name, args in events(0):
+        getattr(net, name)(*args)
+    version, costs, roots = net.topo.snapshot()
+    trees = net.topo.solver(costs, roots)
+    net.topo.diff(net.flush(trees, version))
+    assert reported(net) == expected(net)
+
+
+def test_outdated_trees_discarded():
+    net = Network(deferred=True)
+    for dpid in (1, 2, 3):
+        net.add_switch(dpid)
+    net.add_peer(1, 2, 2)
+    version, costs, roots = net.topo.snapshot()
+    trees = net.topo.solver(costs, roots)
+    net.add_peer(2, 3, 3)
+    assert net.flush(trees, version) is None
+    assert net.flush() is not None
+
+
+def test_diff_added_changed_removed():
+    net = Network()
+    for dpid in (1, 2, 3):
+        net.add_switch(dpid)
+    topo = net.topo
+    topo.diff(net.add_peer(1, 2, 12))
+    topo.diff(net.add_peer(2, 1, 21))
+
+    delta = topo.diff(net.add_peer(1, 3, 13) | net.add_peer(3, 1, 31) |
+                      net.add_peer(2, 3, 23) | net.add_peer(3, 2, 32))
+    assert delta[1]["added"] == {3: ((13,), 12)}
+    assert delta[2]["added"] == {3: ((23,), 21)}
+
+    delta = topo.diff(net.set_metric(1, 13, 5))
+    assert delta[1]["changed"] == {3: ((12,), 13)}
+
+    delta = topo.diff(net.purge(3))
+    assert delta[1]["removed"] == {3: ((12,), 13)}
+    assert 3 not in topo.fib[1]
+    assert topo.diff([(1, 2)]) == {}
+
+
+def test_unroute_reports_again():
+    net = Network()
+    for dpid in (1, 2):
+        net.add_switch(dpid)
+    topo = net.topo
+    topo.diff(net.add_peer(1, 2, 12) | net.add_peer(2, 1, 21))
+    assert topo.diff([(1, 2)]) == {}
+    topo.unroute(1, 2)
+    assert topo.diff([(1, 2)])[1]["added"] == {2: ((12,), None)}
+
+
+def test_reconnect_reports_all_routes():
+    net = Network()
+    for dpid in (1, 2, 3):
+        net.add_switch(dpid)
+    net.topo.diff(net.add_peer(1, 2, 12) | net.add_peer(2, 1, 21) |
+                  net.add_peer(2, 3, 23) | net.add_peer(3, 2, 32))
+    delta = net.topo.diff(net.add_switch(2))
+    assert set(delta[2]["added"]) == set([1, 3])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_uniform_trees(seed):
+    rnd = random.Random(seed)
+    costs = {}
+    for a in range(20):
+        for b in range(20):
+            if a != b and rnd.random() < 0.15:
+                costs.setdefault(a, {})[b] = 3
+    trees = uniform_trees(costs, list(range(20)), 3)
+    for root in range(20):
+        assert trees[root] == shortest_path_tree(costs, root)
+
+
+def test_deferred_reconnect_reports_routes_right_away():
+    net = Network(deferred=True)
+    for dpid in (1, 2, 3):
+        net.add_switch(dpid)
+    for src, dst in ((1, 2), (2, 1), (2, 3), (3, 2)):
+        net.add_peer(src, dst, dst)
+    net.topo.diff(net.flush())
+    delta = net.topo.diff(net.add_switch(2))
+    assert delta[2]["added"] == {1: ((1,), None), 3: ((3,), None)}
+    assert net.topo.diff(net.flush()) == {}
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+def test_switch_back_reports_routes_towards_it(incremental):
+    net = Network(incremental=incremental)
+    for dpid in (1, 2, 3):
+        net.add_switch(dpid)
+    for src, dst in ((1, 2), (2, 1), (2, 3), (3, 2)):
+        net.add_peer(src, dst, dst)
+    net.purge(3)
+    net.add_peer(2, 3, 3)
+    assert (1, 3) in net.add_switch(3)
@@ -0,0 +1,107 @@
+"""
+Headers parsed straight from frames match what Ryu decodes of them.
+"""
+import struct
+
+import pytest
+
+ryu_packet = pytest.importorskip("ryu.lib.packet.packet")
+
+from ryu.lib.packet import arp, ethernet, lldp  # noqa: E402
+from ryu.ofproto import ether as ethertypes  # noqa: E402
+
+from fabric import packet  # noqa: E402
+
+
+def decode(data):
+    """
+    Headers of a frame the way Ryu packet objects give them.
+    """
+    pkt = ryu_packet.Packet(bytes(data))
+    eth = pkt.get_protocol(ethernet.ethernet)
+    headers = {"dl_src": eth.src, "dl_dst": eth.dst,
+               "ethertype": eth.ethertype}
+    pkt_arp = pkt.get_protocol(arp.arp)
+    if pkt_arp is not None:
+        headers.update(nl_src=pkt_arp.src_ip, nl_dst=pkt_arp.dst_ip,
+                       opcode=pkt_arp.opcode)
+    pkt_lldp = pkt.get_protocol(lldp.lldp)
+    if pkt_lldp is not None:
+        headers.update(peer_id=int(pkt_lldp.tlvs[0].chassis_id, 16),
+                       peer_port=int(pkt_lldp.tlvs[1].port_id, 16))
+    return headers
+
+
+def arp_request(dl_src, nl_src, nl_dst):
+    """
+    Serialize an ARP request with Ryu.
+    """
+    pkt = ryu_packet.Packet()
+    pkt.add_protocol(ethernet.ethernet("ff:ff:ff:ff:ff:ff", dl_src,
+                                       ethertypes.ETH_TYPE_ARP))
+    pkt.add_protocol(arp.arp(opcode=arp.ARP_REQUEST, src_mac=dl_src,
+                             src_ip=nl_src, dst_mac="00:00:00:00:00:00",
+                             dst_ip=nl_dst))
+    pkt.serialize()
+    return pkt.data
+
+
+@pytest.mark.parametrize("frame", [
+    packet.create_arp("00:00:00:00:00:01", "00:00:00:00:00:02",
+                      "10.0.0.1", "10.0.0.2"),
+    arp_request("0a:00:00:00:00:03", "192.168.1.3", "192.168.1.254"),
+])
+def test_arp(frame):
+    assert packet.parse(frame) == decode(frame)
+
+
+@pytest.mark.parametrize("dpid, port_no", [
+    (1, 1), (0x1234, 48), (2 ** 64 - 1, 0xfffffffe), (7, 0xfffffffb)])
+def test_own_lldp(dpid, port_no):
+    frame = packet.create_lldp(dpid, port_no)
+    headers = packet.parse(frame)
+    assert headers == decode(frame)
+    assert (headers["peer_id"], headers["peer_port"]) == (dpid, port_no)
+    assert packet.parse_lldp(frame) == {"peer_id": dpid, "peer_port": port_no}
+
+
+def test_foreign_lldp():
+    pkt = ryu_packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(lldp.LLDP_MAC_NEAREST_BRIDGE,
+                                       "0a:00:00:00:00:01",
+                                       ethertypes.ETH_TYPE_LLDP))
+    pkt.add_protocol(lldp.lldp([
+        lldp.ChassisID(subtype=lldp.ChassisID.SUB_MAC_ADDRESS,
+                       chassis_id=b"\x0a\x00\x00\x00\x00\x01"),
+        lldp.PortID(subtype=lldp.PortID.SUB_INTERFACE_NAME,
+                    port_id=b"eth0"),
+        lldp.TTL(ttl=120),
+        lldp.End()]))
+    pkt.serialize()
+    assert ryu_packet.Packet(pkt.data).get_protocol(lldp.lldp) is not None
+    assert packet.parse_lldp(pkt.data) == {}
+    headers = packet.parse(pkt.data)
+    assert "peer_id" not in headers and "peer_port" not in headers
+
+
+def test_truncated_arp():
+    frame = arp_request("0a:00:00:00:00:03", "192.168.1.3", "192.168.1.254")
+    frame = frame[:packet.ETH_HEADER.size + 10]
+    assert ryu_packet.Packet(frame).get_protocol(arp.arp) is None
+    assert len(frame) < packet.ARP_FRAME.size
+    with pytest.raises(struct.error):
+        packet.parse(frame)
+
+
+@pytest.mark.parametrize("size", [14, 16, 20, 30])
+def test_truncated_lldp(size):
+    frame = bytes(packet.create_lldp(0x1234, 48))[:size]
+    headers = packet.parse(frame)
+    assert "peer_id" not in headers and "peer_port" not in headers
+    assert headers["ethertype"] == ethertypes.ETH_TYPE_LLDP
+    try:
+        decoded = ryu_packet.Packet(frame).get_protocol(lldp.lldp)
+    except AssertionError:  # Ryu asserts TLVs are complete
+        decoded = None
+    assert decoded is None or not any(
+        isinstance(tlv, lldp.PortID) for tlv in decoded.tlvs)
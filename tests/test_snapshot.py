@@ -0,0 +1,75 @@
+"""
+Network snapshots stay as they were taken while the network moves on.
+"""
+from fabric.network import Network
+
+
+def line(net, *dpids):
+    """
+    Connect switches one after another.
+    """
+    for dpid in dpids:
+        net.add_switch(dpid)
+    for src, dst in zip(dpids, dpids[1:]):
+        net.add_peer(src, dst, dst)
+        net.add_peer(dst, src, src)
+
+
+def test_versions():
+    net = Network()
+    line(net, 1, 2, 3)
+    net.learn_host("00:00:00:00:00:01", 1, 10, "10.0.0.1")
+    first = net.snapshot()
+    assert first.version == 1
+    assert first.switches == frozenset([1, 2, 3])
+    assert dict(first.links) == {(1, 2): 2, (2, 1): 1, (2, 3): 3, (3, 2): 2}
+    assert first.mac_to_port["00:00:00:00:00:01"] == (1, 10)
+    assert first.ip_to_mac["10.0.0.1"] == "00:00:00:00:00:01"
+    assert first.path(1, 3) == [1, 2, 3]
+
+    net.purge(3)
+    net.learn_host("00:00:00:00:00:02", 2, 11, "10.0.0.2")
+    second = net.snapshot()
+    assert second.version == 2
+    assert second.switches == frozenset([1, 2])
+    assert dict(second.links) == {(1, 2): 2, (2, 1): 1}
+    assert second.mac_to_port["00:00:00:00:00:02"] == (2, 11)
+    assert second.path(1, 3) is None
+
+    assert first.switches == frozenset([1, 2, 3])
+    assert (2, 3) in first.links
+    assert "00:00:00:00:00:02" not in first.mac_to_port
+    assert first.path(1, 3) == [1, 2, 3]
+
+
+def test_unchanged_returns_previous():
+    net = Network()
+    line(net, 1, 2)
+    snapshot = net.snapshot()
+    assert net.snapshot() is snapshot
+    net.add_peer(1, 2, 2)
+    assert net.snapshot() is snapshot
+    net.set_metric(1, 2, 5)
+    assert net.snapshot() is not snapshot
+
+
+def test_stale_trees_left_out():
+    net = Network(deferred=True)
+    line(net, 1, 2, 3)
+    net.flush()
+    net.add_peer(1, 3, 3)
+    net.add_peer(3, 1, 1)
+    snapshot = net.snapshot()
+    assert snapshot.stale == frozenset([1, 3])
+    assert snapshot.path(2, 3) == [2, 3]
+    for root in snapshot.stale:
+        assert snapshot.path(root, 2) is None
+        assert snapshot.next_hops(root, 2) == ()
+
+    net.flush()
+    flushed = net.snapshot()
+    assert flushed.version == snapshot.version + 1
+    assert not flushed.stale
+    assert flushed.path(1, 3) == [1, 3]
+    assert flushed.next_hops(1, 3) == (3,)
+    assert snapshot.path(1, 3) is None
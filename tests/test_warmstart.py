@@ -0,0 +1,122 @@
+"""
+Warm start snapshots restore the network they were taken of.
+"""
+import struct
+
+import pytest
+
+from fabric import warmstart
+from fabric.network import Network
+
+
+BIG = 2 ** 63 + 5  #: dpid that doesn't fit a signed 64 bit integer
+
+
+def build():
+    """
+    Produce a small network with everything a snapshot holds.
+    """
+    net = Network()
+    for dpid in (1, 2, 3, BIG):
+        net.add_switch(dpid)
+    for src, dst in ((1, 2), (2, 3), (3, BIG), (BIG, 1), (1, 3)):
+        net.add_peer(src, dst, dst % 1000)
+        net.add_peer(dst, src, src % 1000)
+    net.set_port_speed(1, 2, 1000000)
+    net.set_metric(2, 3, 7)
+    net.learn_host("00:00:00:00:00:01", 1, 10, "10.0.0.1")
+    net.learn_host("00:00:00:00:00:02", BIG, 11, "10.0.0.2")
+    net.learn_host("00:00:00:00:00:03", 3, 12)
+    return net
+
+
+def routes(net):
+    """
+    Next hops, backup next hop and path of all pairs.
+    """
+    topo = net.topo
+    return dict(((src, dst), (topo.next_hops(src, dst),
+                              topo.backup_hop(src, dst),
+                              topo.paths[src, dst]))
+                for src in topo.switches for dst in topo.switches
+                if src != dst)
+
+
+def test_round_trip(tmp_path):
+    net = build()
+    path = str(tmp_path / "fabric.ws")
+    warmstart.save(net, path)
+    restored = warmstart.load(path)
+
+    assert restored.topo.switches == net.topo.switches
+    assert dict(restored.topo.items()) == dict(
+        (key, port_no) for key, port_no in net.topo.items()
+        if port_no is not None)
+    assert restored.topo.costs == net.topo.costs
+    assert restored.port_speed == net.port_speed
+    assert restored.metrics == net.metrics
+    assert dict(restored.mac_to_port) == dict(net.mac_to_port)
+    assert dict(restored.ip_to_mac) == dict(net.ip_to_mac)
+    assert routes(restored) == routes(net)
+    assert restored.unconfirmed == net.topo.switches | set(
+        key for key, port_no in net.topo.items() if port_no is not None)
+
+
+def test_restored_trees_are_current(tmp_path):
+    path = str(tmp_path / "fabric.ws")
+    warmstart.save(build(), path)
+    restored = warmstart.load(path)
+    before = routes(restored)
+    restored.topo.run_spf()
+    assert routes(restored) == before
+
+
+def test_validate_forgets_hosts_of_unseen_switches(tmp_path):
+    path = str(tmp_path / "fabric.ws")
+    warmstart.save(build(), path)
+    restored = warmstart.load(path)
+    for dpid in (1, 2, 3):
+        restored.add_switch(dpid)
+    restored.validate()
+    assert BIG not in restored.topo.switches
+    assert restored.port_of_mac("00:00:00:00:00:02") is None
+    assert restored.mac_of_ip("10.0.0.2") is None
+    assert restored.port_of_mac("00:00:00:00:00:01") == (1, 10)
+
+
+def test_save_replaces_atomically(tmp_path):
+    path = str(tmp_path / "fabric.ws")
+    warmstart.save(Network(), path)
+    warmstart.save(build(), path)
+    assert warmstart.load(path).topo.switches == set([1, 2, 3, BIG])
+    assert not (tmp_path / "fabric.ws.tmp").exists()
+
+
+def test_empty_network(tmp_path):
+    path = str(tmp_path / "fabric.ws")
+    warmstart.save(Network(), path)
+    restored = warmstart.load(path)
+    assert not restored.topo.switches
+    assert not restored.unconfirmed
+
+
+@pytest.mark.parametrize("size", [0, 3, 8, 40, 48])
+def test_truncated(tmp_path, size):
+    path = str(tmp_path / "fabric.ws")
+    warmstart.save(build(), path)
+    with open(path, "rb") as f:
+        data = f.read(size)
+    with open(path, "wb") as f:
+        f.write(data)
+    with pytest.raises(ValueError):
+        warmstart.load(path)
+
+
+def test_other_format(tmp_path):
+    path = str(tmp_path / "fabric.ws")
+    warmstart.save(build(), path)
+    with open(path, "r+b") as f:
+        f.seek(4)
+        f.write(struct.pack("<H", warmstart.FORMAT + 1))
+    with pytest.raises(ValueError):
+        warmstart.load(path)